@@ -0,0 +1,131 @@
+# Advection of grid quantities for the grid fluids
+# Semi-Lagrangian advection traces every cell back along the velocity and interpolates the old values
+# there. It reads one field and writes another, so the result does not depend on the order of the
+# threads, but the interpolation smooths out detail every step.
+# MacCormack and BFECC advect the result back again, take half the difference to the original as an
+# estimate of that error and correct for it:
+#   maccormack: forward + (q - backward) / 2                       2 advections
+#   bfecc:      semi_lagrangian(q + (q - backward) / 2)            3 advections
+# where forward = semi_lagrangian(q) and backward = forward advected with -dt. The corrected values are
+# clamped to the values the semi-Lagrangian step interpolated between, so they cannot overshoot.
+# Scalar and vector fields of any dimension; positions are normalized like in grid_fluid.py, cell I is
+# at I / shape. The outermost ring of cells is copied, it is the boundary of the fluids.
+# The kernels visit the cells of q, so with a sparse q only its active cells are advected.
+#
+#   advection = Advection("maccormack")
+#   advection.advect(velocity, velocity, new_velocity, dt)
+#   advection.advect(velocity, dye, new_dye, dt)
+
+import taichi as ti
+
+
+@ti.data_oriented
+class Advection:
+    modes = ["semi-lagrangian", "maccormack", "bfecc"]
+
+    def __init__(self, mode="maccormack"):
+        if mode not in self.modes:
+            raise ValueError(f"unknown advection mode {mode}, expected one of {self.modes}")
+        self.mode = mode
+        # temporaries of the corrected modes, one per kind of field
+        self.temporaries = {}
+
+    def temporary(self, field):
+        n = getattr(field, "n", None)
+        key = (field.shape, field.dtype, n)
+        if key not in self.temporaries:
+            if n is None:
+                self.temporaries[key] = ti.field(dtype=field.dtype, shape=field.shape)
+            else:
+                self.temporaries[key] = ti.Vector.field(n, dtype=field.dtype, shape=field.shape)
+        return self.temporaries[key]
+
+    @ti.func
+    def is_boundary(self, q: ti.template(), I):
+        boundary = False
+        for k in ti.static(range(len(q.shape))):
+            if I[k] == 0 or I[k] == q.shape[k] - 1:
+                boundary = True
+        return boundary
+
+    @ti.func
+    def backtrace(self, velocity: ti.template(), I, dt):
+        # the position in cells the value at I comes from, inside the field
+        shape = ti.Vector(velocity.shape)
+        p = I - velocity[I] * dt * shape
+        return ti.math.clamp(p, 0.0, shape - 1.0)
+
+    @ti.func
+    def corners(self, q: ti.template(), p):
+        base = ti.min(ti.cast(p, int), ti.Vector(q.shape) - 2)
+        return base, p - base
+
+    @ti.func
+    def sample(self, q: ti.template(), p):
+        # multilinear interpolation
+        base, t = self.corners(q, p)
+        value = q[base] * 0.0
+        for corner in ti.static(ti.grouped(ti.ndrange(*([2] * ti.static(len(q.shape)))))):
+            weight = 1.0
+            for k in ti.static(range(len(q.shape))):
+                weight *= corner[k] * t[k] + (1 - corner[k]) * (1.0 - t[k])
+            value += weight * q[base + corner]
+        return value
+
+    @ti.func
+    def clamp_to_corners(self, q: ti.template(), p, value):
+        base, _ = self.corners(q, p)
+        low = q[base]
+        high = q[base]
+        for corner in ti.static(ti.grouped(ti.ndrange(*([2] * ti.static(len(q.shape)))))):
+            low = ti.min(low, q[base + corner])
+            high = ti.max(high, q[base + corner])
+        return ti.min(ti.max(value, low), high)
+
+    @ti.kernel
+    def semi_lagrangian(self, velocity: ti.template(), q: ti.template(), result: ti.template(), dt: float):
+        for I in ti.grouped(q):
+            if self.is_boundary(q, I):
+                result[I] = q[I]
+            else:
+                result[I] = self.sample(q, self.backtrace(velocity, I, dt))
+
+    @ti.kernel
+    def correct(self, q: ti.template(), backward: ti.template(), corrected: ti.template()):
+        # BFECC: q + (q - backward) / 2, unclamped, the final advection clamps
+        for I in ti.grouped(q):
+            corrected[I] = q[I] + 0.5 * (q[I] - backward[I])
+
+    @ti.kernel
+    def correct_forward(self, velocity: ti.template(), q: ti.template(), backward: ti.template(), result: ti.template(), dt: float):
+        # MacCormack: result holds forward, corrected in place
+        for I in ti.grouped(q):
+            if not self.is_boundary(q, I):
+                value = result[I] + 0.5 * (q[I] - backward[I])
+                result[I] = self.clamp_to_corners(q, self.backtrace(velocity, I, dt), value)
+
+    @ti.kernel
+    def limited_semi_lagrangian(self, velocity: ti.template(), q: ti.template(), corrected: ti.template(), result: ti.template(), dt: float):
+        # BFECC: advects the corrected values, clamped to the corners in q
+        for I in ti.grouped(q):
+            if self.is_boundary(q, I):
+                result[I] = q[I]
+            else:
+                p = self.backtrace(velocity, I, dt)
+                result[I] = self.clamp_to_corners(q, p, self.sample(corrected, p))
+
+    def advect(self, velocity, q, result, dt, backward=None):
+        # result = q moved along velocity for dt; result must be another field than q and velocity.
+        # The corrected modes need a field like q as scratch space, a dense one unless backward is given.
+        if self.mode == "semi-lagrangian":
+            self.semi_lagrangian(velocity, q, result, dt)
+            return
+        if backward is None:
+            backward = self.temporary(q)
+        self.semi_lagrangian(velocity, q, result, dt)
+        self.semi_lagrangian(velocity, result, backward, -dt)
+        if self.mode == "maccormack":
+            self.correct_forward(velocity, q, backward, result, dt)
+        else:
+            self.correct(q, backward, backward)
+            self.limited_semi_lagrangian(velocity, q, backward, result, dt)
@@ -0,0 +1,12 @@
+import time
+import taichi as ti
+
+
+def measure(func, repeat=3):
+    func()  # warm up / compile
+    ti.sync()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    ti.sync()
+    return (time.perf_counter() - start) / repeat
@@ -0,0 +1,315 @@
+# Bounding volume hierarchy for spheres
+# Binned SAH build on the host, flat Taichi fields in depth-first order and
+# stackless traversal through "miss" links (next node when a subtree is skipped).
+
+import numpy as np
+import taichi as ti
+from raytracing import intersect_sphere, occluded_sphere, eps
+
+
+def surface_area(box_min, box_max):
+    d = np.maximum(box_max - box_min, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+def segment_bounds(box_min, box_max, offsets):
+    return np.minimum.reduceat(box_min, offsets), np.maximum.reduceat(box_max, offsets)
+
+
+def split_level(box_min, box_max, centroids, counts, num_bins):
+    # Binned SAH for every node of one level at once; primitives of node k are the
+    # k-th contiguous segment of the inputs. Returns a permutation that sorts each
+    # segment by bin and the number of primitives going to each left child.
+    num_segments = counts.shape[0]
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    segment = np.repeat(np.arange(num_segments), counts)
+    c_min, c_max = segment_bounds(centroids, centroids, offsets)
+    axis = np.argmax(c_max - c_min, axis=1)
+    low = c_min[np.arange(num_segments), axis]
+    extent = c_max[np.arange(num_segments), axis] - low
+    degenerate = extent <= 0.0
+
+    c = centroids[np.arange(segment.shape[0]), axis[segment]]
+    bins = ((c - low[segment]) / np.where(degenerate, 1.0, extent)[segment] * num_bins).astype(np.int64)
+    key = segment * num_bins + np.clip(bins, 0, num_bins - 1)
+    perm = np.argsort(key)
+    key = key[perm]
+    runs = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+    bin_count = np.bincount(key, minlength=num_segments * num_bins).reshape(num_segments, num_bins)
+    bin_min = np.full((num_segments * num_bins, 3), np.inf, dtype=box_min.dtype)
+    bin_max = np.full((num_segments * num_bins, 3), -np.inf, dtype=box_max.dtype)
+    bin_min[key[runs]], bin_max[key[runs]] = segment_bounds(
+        np.take(box_min, perm, axis=0), np.take(box_max, perm, axis=0), runs)
+    bin_min = bin_min.reshape(num_segments, num_bins, 3)
+    bin_max = bin_max.reshape(num_segments, num_bins, 3)
+
+    left_count = np.cumsum(bin_count, axis=1)[:, :-1]
+    left_area = surface_area(np.minimum.accumulate(bin_min, axis=1), np.maximum.accumulate(bin_max, axis=1))[:, :-1]
+    right_count = np.cumsum(bin_count[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    right_area = surface_area(np.minimum.accumulate(bin_min[:, ::-1], axis=1),
+                              np.maximum.accumulate(bin_max[:, ::-1], axis=1))[:, ::-1][:, 1:]
+    cost = left_count * left_area + right_count * right_area
+    cost[(left_count == 0) | (right_count == 0)] = np.inf
+    best = np.argmin(cost, axis=1)
+    median = degenerate | ~np.isfinite(cost[np.arange(num_segments), best])
+    return perm, np.where(median, counts // 2, left_count[np.arange(num_segments), best])
+
+
+def build_bvh(box_min, box_max, leaf_size=4, num_bins=16):
+    num_prims = box_min.shape[0]
+    order = np.arange(num_prims, dtype=np.int32)
+    # primitive data is kept in the same order as `order` so that segments stay contiguous
+    box_min, box_max = box_min.astype(np.float32), box_max.astype(np.float32)
+    centroids = (box_min + box_max) * 0.5
+    # nodes in breadth-first order; children of an interior node are allocated as a pair
+    levels = []  # (min, max, start, count, left child) per depth
+    starts, counts = np.array([0]), np.array([num_prims])
+    num_nodes = 1
+    while starts.shape[0] > 0:
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        gather = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+        prims = order[gather]
+        level_min, level_max = segment_bounds(np.take(box_min, gather, axis=0), np.take(box_max, gather, axis=0), offsets)
+        is_leaf = counts <= leaf_size
+        left = np.full(starts.shape[0], -1)
+        left[~is_leaf] = num_nodes + 2 * np.arange(np.count_nonzero(~is_leaf))
+        num_nodes += 2 * np.count_nonzero(~is_leaf)
+        levels.append((level_min, level_max, starts, np.where(is_leaf, counts, 0), left))
+
+        split = np.repeat(~is_leaf, counts)
+        starts, counts = starts[~is_leaf], counts[~is_leaf]
+        if starts.shape[0] == 0:
+            break
+        gather, prims = gather[split], prims[split]
+        split_min, split_max, split_centroids = [np.take(a, gather, axis=0) for a in (box_min, box_max, centroids)]
+        perm, left_counts = split_level(split_min, split_max, split_centroids, counts, num_bins)
+        order[gather] = prims[perm]
+        for a, split_a in [(box_min, split_min), (box_max, split_max), (centroids, split_centroids)]:
+            a[gather] = np.take(split_a, perm, axis=0)
+        starts = np.stack([starts, starts + left_counts], axis=1).ravel()
+        counts = np.stack([left_counts, counts - left_counts], axis=1).ravel()
+
+    bfs_min, bfs_max, bfs_start, bfs_count, bfs_left = [np.concatenate(x) for x in zip(*levels)]
+    level_ranges = np.cumsum([0] + [level[0].shape[0] for level in levels])
+
+    # depth-first renumbering (the left child becomes node + 1), one level at a time
+    subtree_size = np.ones(num_nodes, dtype=np.int64)
+    for l in reversed(range(len(levels))):
+        nodes = np.arange(level_ranges[l], level_ranges[l + 1])
+        inner = nodes[bfs_left[nodes] != -1]
+        subtree_size[inner] += subtree_size[bfs_left[inner]] + subtree_size[bfs_left[inner] + 1]
+
+    # miss link: where to continue when the subtree of a node is done or skipped
+    dfs = np.zeros(num_nodes, dtype=np.int64)
+    bfs_miss = np.full(num_nodes, -1, dtype=np.int64)
+    for l in range(len(levels)):
+        nodes = np.arange(level_ranges[l], level_ranges[l + 1])
+        inner = nodes[bfs_left[nodes] != -1]
+        left, right = bfs_left[inner], bfs_left[inner] + 1
+        dfs[left] = dfs[inner] + 1
+        dfs[right] = dfs[inner] + 1 + subtree_size[left]
+        bfs_miss[left] = dfs[right]
+        bfs_miss[right] = bfs_miss[inner]
+
+    node_min = np.zeros((num_nodes, 3), dtype=np.float32)
+    node_max = np.zeros((num_nodes, 3), dtype=np.float32)
+    node_start = np.zeros(num_nodes, dtype=np.int32)
+    node_count = np.zeros(num_nodes, dtype=np.int32)
+    node_miss = np.zeros(num_nodes, dtype=np.int32)
+    node_min[dfs], node_max[dfs], node_start[dfs] = bfs_min, bfs_max, bfs_start
+    node_count[dfs], node_miss[dfs] = bfs_count, bfs_miss
+    return node_min, node_max, node_start, node_count, node_miss, order
+
+
+@ti.func
+def intersect_aabb(origin, inv_direction, box_min, box_max, max_distance):
+    t0 = (box_min - origin) * inv_direction
+    t1 = (box_max - origin) * inv_direction
+    t_near = ti.min(t0, t1).max()
+    t_far = ti.max(t0, t1).min()
+    return t_near <= t_far and t_far > eps and t_near < max_distance
+
+
+@ti.data_oriented
+class BVH:
+    # Subclasses provide primitive_bounds() on the host and the primitive_box()
+    # and intersect_primitive() funcs used by refit and traversal.
+    def __init__(self, num_prims, leaf_size=4, num_bins=16):
+        self.leaf_size = leaf_size
+        self.num_bins = num_bins
+        max_nodes = max(2 * num_prims - 1, 1)
+        self.node_min = ti.Vector.field(3, dtype=float, shape=max_nodes)
+        self.node_max = ti.Vector.field(3, dtype=float, shape=max_nodes)
+        self.node_start = ti.field(dtype=int, shape=max_nodes)
+        self.node_count = ti.field(dtype=int, shape=max_nodes)
+        self.node_miss = ti.field(dtype=int, shape=max_nodes)
+        self.prim_indices = ti.field(dtype=int, shape=num_prims)
+        self.num_nodes = 0
+        self.build()
+
+    def build(self):
+        node_min, node_max, node_start, node_count, node_miss, order = build_bvh(
+            *self.primitive_bounds(), self.leaf_size, self.num_bins)
+        self.num_nodes = node_min.shape[0]
+        for field, data in [(self.node_min, node_min), (self.node_max, node_max),
+                            (self.node_start, node_start), (self.node_count, node_count),
+                            (self.node_miss, node_miss)]:
+            padded = np.zeros(field.shape + data.shape[1:], dtype=data.dtype)
+            padded[:self.num_nodes] = data
+            field.from_numpy(padded)
+        self.prim_indices.from_numpy(order)
+
+    def refit(self):
+        # Keeps the topology and only recomputes bounds; rebuild once quality degrades
+        self._refit(self.num_nodes)
+
+    @ti.kernel
+    def _refit(self, num_nodes: int):
+        ti.loop_config(serialize=True)  # children always come after their parent
+        for k in range(num_nodes):
+            node = num_nodes - 1 - k
+            count = self.node_count[node]
+            box_min = ti.Vector([1e30, 1e30, 1e30])
+            box_max = ti.Vector([-1e30, -1e30, -1e30])
+            if count > 0:
+                start = self.node_start[node]
+                for p in range(start, start + count):
+                    prim_min, prim_max = self.primitive_box(self.prim_indices[p])
+                    box_min = ti.min(box_min, prim_min)
+                    box_max = ti.max(box_max, prim_max)
+            else:
+                left = node + 1
+                right = self.node_miss[left]
+                box_min = ti.min(self.node_min[left], self.node_min[right])
+                box_max = ti.max(self.node_max[left], self.node_max[right])
+            self.node_min[node] = box_min
+            self.node_max[node] = box_max
+
+    @ti.func
+    def intersect(self, origin, direction):
+        hit_distance = 10000.0
+        hit_position = ti.Vector([0.0, 0.0, 0.0])
+        hit_normal = ti.Vector([0.0, 0.0, 0.0])
+        hit_prim = -1
+        inv_direction = 1.0 / ti.select(ti.abs(direction) < 1e-12, 1e-12, direction)  # no 0 * inf in the slab test
+        node = 0
+        while node != -1:
+            if intersect_aabb(origin, inv_direction, self.node_min[node], self.node_max[node], hit_distance):
+                count = self.node_count[node]
+                if count == 0:
+                    node += 1
+                    continue
+                start = self.node_start[node]
+                for p in range(start, start + count):
+                    prim = self.prim_indices[p]
+                    distance, position, normal = self.intersect_primitive(prim, origin, direction)
+                    if distance < hit_distance:
+                        hit_distance = distance
+                        hit_position = position
+                        hit_normal = normal
+                        hit_prim = prim
+            node = self.node_miss[node]
+        return hit_distance, hit_position, hit_normal, hit_prim
+
+    @ti.func
+    def occluded(self, origin, direction, max_distance):
+        # any-hit traversal for shadow rays: boxes are culled at max_distance and the first hit ends it
+        hit = False
+        inv_direction = 1.0 / ti.select(ti.abs(direction) < 1e-12, 1e-12, direction)
+        node = 0
+        while node != -1:
+            if intersect_aabb(origin, inv_direction, self.node_min[node], self.node_max[node], max_distance):
+                count = self.node_count[node]
+                if count == 0:
+                    node += 1
+                    continue
+                start = self.node_start[node]
+                for p in range(start, start + count):
+                    if self.occluded_primitive(self.prim_indices[p], origin, direction, max_distance):
+                        hit = True
+                        break
+                if hit:
+                    break
+            node = self.node_miss[node]
+        return hit
+
+    @ti.func
+    def occluded_primitive(self, prim, origin, direction, max_distance):
+        # subclasses can override this with a test that skips the hit position and normal
+        return self.intersect_primitive(prim, origin, direction)[0] < max_distance
+
+
+@ti.data_oriented
+class SphereBVH(BVH):
+    def __init__(self, sphere_centers, sphere_radiuses, leaf_size=4, num_bins=16):
+        self.sphere_centers = sphere_centers
+        self.sphere_radiuses = sphere_radiuses
+        super().__init__(sphere_centers.shape[0], leaf_size, num_bins)
+
+    def primitive_bounds(self):
+        centers = self.sphere_centers.to_numpy()
+        radiuses = self.sphere_radiuses.to_numpy()[:, None]
+        return centers - radiuses, centers + radiuses
+
+    @ti.func
+    def primitive_box(self, s):
+        r = self.sphere_radiuses[s]
+        return self.sphere_centers[s] - r, self.sphere_centers[s] + r
+
+    @ti.func
+    def intersect_primitive(self, s, origin, direction):
+        return intersect_sphere(origin, direction, self.sphere_centers[s], self.sphere_radiuses[s])
+
+    @ti.func
+    def occluded_primitive(self, s, origin, direction, max_distance):
+        return occluded_sphere(origin, direction, max_distance, self.sphere_centers[s], self.sphere_radiuses[s])
+
+
+if __name__ == '__main__':
+    from raytracing import intersect_spheres, occluded
+    from bench_util import measure
+
+    ti.init(arch=ti.cpu)
+    width, height = 256, 256
+    image = ti.field(dtype=float, shape=(width, height))
+
+    @ti.kernel
+    def trace(centers: ti.template(), radiuses: ti.template(), accel: ti.template(), any_hit: ti.template()):
+        light_position = ti.Vector([10.0, 10.0, 10.0])
+        for i, j in image:
+            origin = ti.Vector([0.0, 0.0, 1.0])
+            direction = ti.math.normalize(ti.Vector([i / width - 0.5, j / height - 0.5, 0.0]) - origin)
+            _, position, normal, sphere = intersect_spheres(origin, direction, centers, radiuses, accel)
+            value = 0.0
+            if sphere != -1:
+                light_direction = ti.math.normalize(light_position - position)
+                shadow_origin = position + normal * 0.001
+                blocked = False
+                if ti.static(any_hit):
+                    blocked = occluded(shadow_origin, light_direction, ti.math.distance(light_position, shadow_origin),
+                                       centers, radiuses, accel)
+                else:
+                    blocked = intersect_spheres(shadow_origin, light_direction, centers, radiuses, accel)[3] != -1
+                if not blocked:
+                    value = ti.max(ti.math.dot(normal, light_direction), 0.0)
+            image[i, j] = value
+
+    # shadow rays as closest-hit queries vs any-hit occlusion queries
+    print(f"{'spheres':>8} {'build [ms]':>11} {'refit [ms]':>11} {'linear [ms]':>12} {'any-hit':>8} "
+          f"{'bvh [ms]':>9} {'any-hit':>8}")
+    rng = np.random.default_rng(0)
+    for num_spheres in [4, 1000, 100000]:
+        centers = ti.Vector.field(3, dtype=float, shape=num_spheres)
+        radiuses = ti.field(dtype=float, shape=num_spheres)
+        centers.from_numpy(((rng.random((num_spheres, 3)) - 0.5) * [1.0, 1.0, 0.5] - [0.0, 0.0, 0.5]).astype(np.float32))
+        radiuses.from_numpy(np.full(num_spheres, 0.2 / num_spheres ** (1 / 3), dtype=np.float32))
+
+        bvh = SphereBVH(centers, radiuses)
+        build_time = measure(bvh.build, repeat=1)
+        refit_time = measure(bvh.refit)
+        linear_time = measure(lambda: trace(centers, radiuses, None, False), repeat=1)
+        linear_any_time = measure(lambda: trace(centers, radiuses, None, True), repeat=1)
+        bvh_time = measure(lambda: trace(centers, radiuses, bvh, False))
+        bvh_any_time = measure(lambda: trace(centers, radiuses, bvh, True))
+        print(f"{num_spheres:>8} {build_time * 1e3:>11.2f} {refit_time * 1e3:>11.2f} "
+              f"{linear_time * 1e3:>12.2f} {linear_any_time * 1e3:>8.2f} {bvh_time * 1e3:>9.2f} {bvh_any_time * 1e3:>8.2f}")
@@ -0,0 +1,93 @@
+# Edge-avoiding a-trous wavelet denoiser
+# "Edge-Avoiding A-Trous Wavelet Transform for fast Global Illumination Filtering", Dammertz et al., HPG 2010.
+# Filtering happens on the color divided by the first-hit albedo, so texture detail is not blurred.
+
+import argparse
+import numpy as np
+import taichi as ti
+
+
+@ti.data_oriented
+class AtrousDenoiser:
+    def __init__(self, width, height, iterations=5, sigma_color=4.0, sigma_normal=0.3, sigma_depth=0.05):
+        self.iterations = iterations
+        self.sigma_color = sigma_color
+        self.sigma_normal = sigma_normal
+        self.sigma_depth = sigma_depth
+        self.buffers = ti.Vector.field(3, dtype=float, shape=(2, width, height))
+        self.output = ti.Vector.field(3, dtype=float, shape=(width, height))
+
+    @ti.kernel
+    def demodulate(self, colors: ti.template(), albedos: ti.template()):
+        for i, j in colors:
+            self.buffers[0, i, j] = colors[i, j] / ti.max(albedos[i, j], 1e-3)
+
+    @ti.kernel
+    def remodulate(self, src: int, albedos: ti.template()):
+        for i, j in self.output:
+            self.output[i, j] = self.buffers[src, i, j] * ti.max(albedos[i, j], 1e-3)
+
+    @ti.kernel
+    def atrous_step(self, src: int, step: int, sigma_color: float,
+                    normals: ti.template(), depths: ti.template()):
+        kernel = ti.Vector([1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0])
+        width, height = self.output.shape[0], self.output.shape[1]
+        for i, j in self.output:
+            color = self.buffers[src, i, j]
+            normal = normals[i, j]
+            depth = depths[i, j]
+            sum_color = ti.Vector([0.0, 0.0, 0.0])
+            sum_weight = 0.0
+            for dx, dy in ti.static(ti.ndrange(5, 5)):
+                x = ti.math.clamp(i + (dx - 2) * step, 0, width - 1)
+                y = ti.math.clamp(j + (dy - 2) * step, 0, height - 1)
+                q_color = self.buffers[src, x, y]
+                color_distance = ti.math.dot(color - q_color, color - q_color)
+                normal_distance = ti.math.dot(normal - normals[x, y], normal - normals[x, y])
+                depth_distance = (depth - depths[x, y]) / ti.max(depth, 1e-3)
+                weight = ti.exp(-color_distance / (sigma_color * sigma_color)
+                                - normal_distance / (self.sigma_normal * self.sigma_normal)
+                                - depth_distance * depth_distance / (self.sigma_depth * self.sigma_depth))
+                weight *= kernel[dx] * kernel[dy]
+                sum_color += q_color * weight
+                sum_weight += weight
+            self.buffers[1 - src, i, j] = sum_color / sum_weight
+
+    def denoise(self, colors, albedos, normals, depths):
+        self.demodulate(colors, albedos)
+        src = 0
+        for iteration in range(self.iterations):
+            # the hole spacing doubles and the color tolerance halves every iteration
+            self.atrous_step(src, 1 << iteration, self.sigma_color * 0.5 ** iteration, normals, depths)
+            src = 1 - src
+        self.remodulate(src, albedos)
+        return self.output
+
+
+def load_buffers(file_path):
+    data = np.load(file_path)
+    fields = []
+    for name, n in [("colors", 3), ("albedos", 3), ("normals", 3), ("depths", 1)]:
+        array = data[name].astype(np.float32)
+        field = ti.Vector.field(n, dtype=float, shape=array.shape[:2]) if n > 1 else ti.field(dtype=float, shape=array.shape)
+        field.from_numpy(array)
+        fields.append(field)
+    return fields
+
+
+if __name__ == '__main__':
+    # denoise buffers saved by: python pathtracing.py --save-buffers buffers.npz
+    parser = argparse.ArgumentParser()
+    parser.add_argument("buffers", help=".npz file with colors, albedos, normals and depths")
+    parser.add_argument("output", help="denoised image (.png, .jpg or .npy)")
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    ti.init(arch=ti.cpu)
+    colors, albedos, normals, depths = load_buffers(args.buffers)
+    denoiser = AtrousDenoiser(*colors.shape, iterations=args.iterations)
+    image = denoiser.denoise(colors, albedos, normals, depths).to_numpy()
+    if args.output.endswith(".npy"):
+        np.save(args.output, image)
+    else:
+        ti.tools.imwrite(np.clip(image, 0.0, 1.0).astype(np.float32), args.output)
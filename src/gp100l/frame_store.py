@@ -0,0 +1,212 @@
+# Recording simulation frames
+# FrameWriter takes a host copy of the given fields and returns right away; a background thread
+# compresses the frames and writes them, so the simulation only waits when more than max_pending
+# frames are queued. FrameReader reads any frame without touching the ones before it.
+#
+# On disk a recording is a directory:
+#   index.json          array names, dtypes and shapes, frames per chunk, number of frames
+#   chunk_000000.zip    one deflated member per frame and array, e.g. "000003/positions"
+# Arrays are byte-shuffled before compression (all first bytes of the float32 values, then all
+# second bytes, ...), which deflate compresses much better than interleaved floats.
+# The index is rewritten after every chunk, so an interrupted run can be read up to its last chunk.
+#
+#   python particle_fluid.py --frames 1000 --record fluid_frames
+#   python frame_store.py fluid_frames 500
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import zipfile
+import numpy as np
+import taichi as ti
+
+
+def shuffle_bytes(array):
+    return np.ascontiguousarray(array).view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data, dtype, shape):
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+
+
+class FrameWriter:
+    def __init__(self, path, chunk_frames=64, level=6, max_pending=8):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.level = level
+        self.arrays = None
+        self.num_frames = 0
+        os.makedirs(path, exist_ok=True)
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, **arrays):
+        # Taichi fields or numpy arrays; the copies are taken here, on the simulation thread
+        if self.error:
+            raise self.error
+        frame = {name: array.to_numpy() if hasattr(array, "to_numpy") else np.array(array)
+                 for name, array in arrays.items()}
+        layout = {name: {"dtype": array.dtype.str, "shape": list(array.shape)} for name, array in frame.items()}
+        if self.arrays is None:
+            self.arrays = layout
+        elif layout != self.arrays:
+            raise ValueError(f"frame {self.num_frames} has arrays {layout}, the recording has {self.arrays}")
+        self.pending.put((self.num_frames, frame))
+        self.num_frames += 1
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        archive = None
+        try:
+            while True:
+                job = self.pending.get()
+                if job is None:
+                    break
+                frame, arrays = job
+                # frames go straight into the chunk file, which gets its final name once it is complete
+                chunk_path = os.path.join(self.path, f"chunk_{frame // self.chunk_frames:06d}.zip")
+                if archive is None:
+                    archive = zipfile.ZipFile(chunk_path + ".tmp", "w", zipfile.ZIP_DEFLATED, compresslevel=self.level)
+                for name, array in arrays.items():
+                    archive.writestr(f"{frame:06d}/{name}", shuffle_bytes(array))
+                if (frame + 1) % self.chunk_frames == 0:
+                    self.finish_chunk(archive, chunk_path, frame + 1)
+                    archive = None
+            if archive is not None:
+                self.finish_chunk(archive, chunk_path, frame + 1)
+        except Exception as error:
+            self.error = error
+            # keep draining, so that write() raises instead of blocking on a full queue
+            while self.pending.get() is not None:
+                pass
+
+    def finish_chunk(self, archive, chunk_path, num_frames):
+        archive.close()
+        os.replace(chunk_path + ".tmp", chunk_path)
+        index = {"arrays": self.arrays, "chunk_frames": self.chunk_frames, "num_frames": num_frames}
+        index_path = os.path.join(self.path, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+class FrameReader:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+        self.arrays = index["arrays"]
+        self.chunk_frames = index["chunk_frames"]
+        self.num_frames = index["num_frames"]
+        self.archives = {}
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, frame):
+        return self.read(frame)
+
+    def archive(self, chunk):
+        if chunk not in self.archives:
+            self.archives[chunk] = zipfile.ZipFile(os.path.join(self.path, f"chunk_{chunk:06d}.zip"))
+        return self.archives[chunk]
+
+    def read(self, frame, names=None):
+        # only the members of this frame are decompressed
+        if frame < 0:
+            frame += self.num_frames
+        if not 0 <= frame < self.num_frames:
+            raise IndexError(f"frame {frame} out of range for {self.num_frames} frames")
+        archive = self.archive(frame // self.chunk_frames)
+        return {name: unshuffle_bytes(archive.read(f"{frame:06d}/{name}"), self.arrays[name]["dtype"], self.arrays[name]["shape"])
+                for name in (names or self.arrays)}
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+        self.archives = {}
+
+
+if __name__ == '__main__':
+    # python frame_store.py [recording [frame]]: print a frame of a recording, or compare
+    # recording in the background with writing on the simulation thread
+    if len(sys.argv) > 1:
+        reader = FrameReader(sys.argv[1])
+        frame = int(sys.argv[2]) if len(sys.argv) > 2 else len(reader) - 1
+        start = time.perf_counter()
+        arrays = reader.read(frame)
+        print(f"{len(reader)} frames, frame {frame} read in {(time.perf_counter() - start) * 1e3:.2f} ms")
+        for name, array in arrays.items():
+            print(f"  {name}: {array.dtype} {array.shape}, min {array.min():.4g}, max {array.max():.4g}")
+        exit()
+
+    import shutil
+    import tempfile
+    from particle_fluid import ParticleFluid
+
+    ti.init(arch=ti.cpu)
+    num_particles, num_frames = 20000, 200
+    radius = 0.03 * np.sqrt(1000 / num_particles)
+    fluid = ParticleFluid(num_particles, radius)
+    frame_size = 2 * fluid.positions.to_numpy().nbytes
+    print(f"{num_particles} particles, {num_frames} frames, {frame_size / 2 ** 20:.2f} MiB per frame")
+    print(f"{'':>16} {'total [s]':>10} {'blocked [ms/frame]':>19} {'size':>7}")
+
+    def simulate(name, record, finish=lambda: None):
+        # the demo scene; "blocked" is the time the simulation spends in record()
+        fluid.initialize()
+        num_active_particles = 0
+        blocked = 0.0
+        start = time.perf_counter()
+        for frame in range(num_frames):
+            num_active_particles = min(num_active_particles + num_particles // 200, num_particles)
+            fluid.update(num_active_particles)
+            record_start = time.perf_counter()
+            record(positions=fluid.positions, velocities=fluid.velocities)
+            blocked += time.perf_counter() - record_start
+        finish()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / (num_frames * frame_size)
+        print(f"{name:>16} {elapsed:>10.2f} {blocked / num_frames * 1e3:>19.2f} {size:>7.1%}")
+
+    path = tempfile.mkdtemp()
+    try:
+        for _ in range(2):  # compile the kernels for both buffer orders
+            fluid.update(1)
+
+        def savez(save, **arrays):
+            save(os.path.join(path, f"{len(os.listdir(path)):06d}.npz"), **{name: a.to_numpy() for name, a in arrays.items()})
+        simulate("npz", lambda **arrays: savez(np.savez, **arrays))
+        shutil.rmtree(path)
+        os.makedirs(path)
+        simulate("npz compressed", lambda **arrays: savez(np.savez_compressed, **arrays))
+        shutil.rmtree(path)
+        writer = FrameWriter(path)
+        simulate("frame writer", writer.write, writer.close)
+
+        reader = FrameReader(path)
+        for frame in [0, num_frames // 2, num_frames - 1]:
+            start = time.perf_counter()
+            reader.read(frame)
+            print(f"read frame {frame:>4}: {(time.perf_counter() - start) * 1e3:6.2f} ms")
+        reader.close()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,68 +1,63 @@
+import argparse
+import time
 import numpy as np
 import taichi as ti
+from advection import Advection
+from frame_store import FrameWriter
+from multigrid import Multigrid
+from pcg import ConjugateGradient
 
 @ti.func
-def sample_lerp(data: ti.template(), normed_pos: ti.template()):
-    pos = normed_pos * ti.Vector([width, height])
-    x, y = int(pos.x), int(pos.y)
-    tx, ty = pos.x - x, pos.y - y
-    val00 = data[x, y]
-    val10 = data[x + 1, y]
-    val01 = data[x, y + 1]
-    val11 = data[x + 1, y + 1]
-    val0 = ti.math.mix(val00, val10, tx)
-    val1 = ti.math.mix(val01, val11, tx)
-    return ti.math.mix(val0, val1, ty)
+def is_interior(i, j):
+    # the outermost ring of cells is the boundary
+    return 0 < i and i < width - 1 and 0 < j and j < height - 1
 
 
-@ti.kernel
-def compute_pressure(parity: int):
-    for i in range(1, width - 1):
-        for j in range(1, height - 1):
-            if (i + j) % 2 == parity:
-                x0 = pressure[i - 1, j]
-                x1 = pressure[i + 1, j]
-                y0 = pressure[i, j - 1]
-                y1 = pressure[i, j + 1]
-                div = divergence[i, j]
-                pressure[i, j] = (x0 + x1 + y0 + y1 - div) / 4
-
+# The loops run over the cells of the fields, which in the sparse layout are only the active ones.
+# The pressure is dense either way, its loops run over the divergence.
 
 @ti.kernel
-def add_force(cursor: ti.template()):
-    for i in range(1, width - 1):
-        for j in range(1, height - 1):
-            pos = ti.Vector([i / width, j / height])
-            if ti.math.distance(pos, cursor) < 0.1:
-                velocity[i, j] = ti.Vector([0.0, -0.2])
+def compute_pressure(parity: int):
+    for i, j in divergence:
+        if is_interior(i, j) and (i + j) % 2 == parity:
+            x0 = pressure[i - 1, j]
+            x1 = pressure[i + 1, j]
+            y0 = pressure[i, j - 1]
+            y1 = pressure[i, j + 1]
+            div = divergence[i, j]
+            pressure[i, j] = (x0 + x1 + y0 + y1 - div) / 4
 
 
 @ti.kernel
-def advect(dt: float):
-    for i in range(1, width - 1):
-        for j in range(1, height - 1):
-            offset = velocity[i, j] * dt
-            pos = ti.Vector([i / width, j / height])
-            velocity[i, j] = sample_lerp(velocity, pos - offset)
+def add_force(velocity: ti.template(), dye: ti.template(), cursor: ti.types.vector(2, float)):
+    # only the cells around the cursor; writing them activates their blocks
+    radius = 0.1
+    low = ti.max(ti.cast((cursor - radius) * ti.Vector([width, height]), int), 1)
+    high = ti.min(ti.cast((cursor + radius) * ti.Vector([width, height]), int) + 1, ti.Vector([width - 1, height - 1]))
+    for i, j in ti.ndrange((low.x, high.x), (low.y, high.y)):
+        pos = ti.Vector([i / width, j / height])
+        if ti.math.distance(pos, cursor) < radius:
+            velocity[i, j] = ti.Vector([0.0, -0.2])
+            dye[i, j] = 1.0
 
 
 @ti.kernel
-def compute_divergence():
-    for i in range(1, width - 1):
-        for j in range(1, height - 1):
+def compute_divergence(velocity: ti.template(), scale: float):
+    for i, j in divergence:
+        if is_interior(i, j):
             x0 = velocity[i - 1, j].x
             x1 = velocity[i + 1, j].x
             y0 = velocity[i, j - 1].y
             y1 = velocity[i, j + 1].y
             dx = (x1 - x0) / 2.0
             dy = (y1 - y0) / 2.0
-            divergence[i, j] = (dx + dy) * 1.9
+            divergence[i, j] = (dx + dy) * scale
 
 
 @ti.kernel
-def subtract_pressure_gradient():
-    for i in range(1, width - 1):
-        for j in range(1, height - 1):
+def subtract_pressure_gradient(velocity: ti.template()):
+    for i, j in velocity:
+        if is_interior(i, j):
             x0 = pressure[i - 1, j]
             x1 = pressure[i + 1, j]
             y0 = pressure[i, j - 1]
@@ -74,34 +69,267 @@ def subtract_pressure_gradient():
 
 
 @ti.kernel
-def render():
+def mark_blocks(dye: ti.template(), dye_threshold: float):
+    # blocks with dye, and their neighbors, which the flow reaches within a step. Velocity does not keep
+    # a block: the pressure spreads some of it over every cell next to an active one, so blocks kept by
+    # speed would grow into the whole box. A freed block drops its velocity with the rest of its cells.
+    for i, j in dye:
+        if dye[i, j] > dye_threshold:
+            block = ti.Vector([i, j]) // block_size
+            for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
+                neighbor = block + offset
+                if 0 <= neighbor.x < keep.shape[0] and 0 <= neighbor.y < keep.shape[1]:
+                    keep[neighbor] = 1
+
+
+@ti.kernel
+def update_blocks() -> int:
+    # activates the marked blocks, frees the others; returns the number of active blocks
+    count = 0
+    for i, j in keep:
+        # activate() and deactivate() warn unless the indices are cast in place
+        if keep[i, j]:
+            ti.activate(blocks, [ti.cast(i, ti.i32), ti.cast(j, ti.i32)])
+            count += 1
+        elif ti.is_active(blocks, [i, j]):
+            ti.deactivate(blocks, [ti.cast(i, ti.i32), ti.cast(j, ti.i32)])
+            # outside the active blocks the dense pressure and residual are the 0 boundary
+            for k, l in ti.ndrange(block_size, block_size):
+                pressure[i * block_size + k, j * block_size + l] = 0.0
+                residual[i * block_size + k, j * block_size + l] = 0.0
+        keep[i, j] = 0
+    return count
+
+
+@ti.kernel
+def add_vortex(velocity: ti.template(), center: ti.types.vector(2, float), core_radius: float, circulation: float):
+    # Lamb-Oseen vortex, a steady flow
+    for i, j in velocity:
+        if is_interior(i, j):
+            d = ti.Vector([i / width, j / height]) - center
+            r2 = d.norm_sqr() + 1e-12
+            velocity[i, j] = circulation / (2 * ti.math.pi * r2) * (1 - ti.exp(-r2 / core_radius ** 2)) * ti.Vector([-d.y, d.x])
+
+
+@ti.kernel
+def add_disk(q: ti.template(), center: ti.types.vector(2, float), radius: float):
+    for i, j in q:
+        if ti.math.distance(ti.Vector([i / width, j / height]), center) < radius:
+            q[i, j] = 1.0
+
+
+@ti.kernel
+def enstrophy(velocity: ti.template()) -> ti.f64:
+    # sum of the squared vorticity; with derivatives per cell it does not depend on the resolution
+    total = ti.f64(0.0)
+    for i, j in velocity:
+        if is_interior(i, j):
+            dvy = (velocity[i + 1, j].y - velocity[i - 1, j].y) / 2.0
+            dvx = (velocity[i, j + 1].x - velocity[i, j - 1].x) / 2.0
+            total += ti.f64(dvy - dvx) ** 2
+    return total
+
+
+@ti.kernel
+def render(velocity: ti.template(), dye: ti.template()):
     for i, j in colors:
         colors[i, j].xy = ti.abs(velocity[i, j] * 5)
         colors[i, j].z = ti.abs(pressure[i, j] * 5)
+        colors[i, j] += 0.3 * dye[i, j]
 
 
 if __name__ == '__main__':
-    ti.init(arch=ti.vulkan)
-    width, height = 1024, 1024
-    window = ti.ui.Window("Grid-based fluid", (width, height), vsync=True)
-    canvas = window.get_canvas()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=0, help="run this many frames without a window")
+    parser.add_argument("--record", help="record velocity, pressure and dye into this directory, see frame_store.py")
+    parser.add_argument("--solver", choices=["gauss-seidel", "multigrid", "pcg"], default="gauss-seidel")
+    parser.add_argument("--preconditioner", choices=["jacobi", "multigrid"], default="multigrid", help="for --solver pcg")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="relative residual that ends the multigrid and pcg solves")
+    parser.add_argument("--log", action="store_true", help="print the iterations and residual of every pressure solve")
+    parser.add_argument("--advection", choices=Advection.modes, default="semi-lagrangian")
+    parser.add_argument("--resolution", type=int, default=1024)
+    parser.add_argument("--sparse", action="store_true", help="allocate and simulate only blocks of cells with dye nearby")
+    parser.add_argument("--dye-threshold", type=float, default=1e-2, help="less dye does not keep a sparse block active")
+    parser.add_argument("--benchmark", choices=["pressure", "advection"],
+                        help="print residual vs time of the pressure solvers, or how long the advection modes keep a vortex")
+    args = parser.parse_args()
+    if args.sparse and args.solver == "pcg":
+        parser.error("--sparse supports the gauss-seidel and multigrid solvers")
+
+    headless = args.frames or args.benchmark
+    ti.init(arch=ti.cpu if headless else ti.vulkan)
+    width, height = args.resolution, args.resolution
+    if not headless:
+        window = ti.ui.Window("Grid-based fluid", (width, height), vsync=True)
+        canvas = window.get_canvas()
     colors = ti.Vector.field(3, dtype=float, shape=(width, height))
-    velocity = ti.Vector.field(2, dtype=float, shape=(width, height))
-    divergence = ti.field(dtype=float, shape=(width, height))
-    pressure = ti.field(dtype=float, shape=(width, height))
+    if args.sparse:
+        # the simulation fields share blocks of 16x16 cells, which are allocated when they are activated.
+        # The pressure solvers read 4 neighbors of every cell in every sweep, which a sparse field looks
+        # up through its block pointer; that makes a sweep over all cells 2.5x slower than a dense one,
+        # so the pressure and residual stay dense and only their loops follow the blocks.
+        block_size = 16
+        assert width % block_size == 0 and height % block_size == 0
+        blocks = ti.root.pointer(ti.ij, (width // block_size, height // block_size))
+        cells = blocks.dense(ti.ij, block_size)
+        keep = ti.field(dtype=int, shape=(width // block_size, height // block_size))
+    sparse_fields, dense_fields = [], []
 
-    frame = 0
-    while window.running:
+    def grid_field(n=0, sparse=args.sparse):
+        shape = None if sparse else (width, height)
+        field = ti.Vector.field(n, dtype=float, shape=shape) if n else ti.field(dtype=float, shape=shape)
+        if sparse:
+            cells.place(field)
+        (sparse_fields if sparse else dense_fields).append(field)
+        return field
+
+    # advection reads one and writes the other
+    velocity, new_velocity = grid_field(2), grid_field(2)
+    dye, new_dye = grid_field(), grid_field()
+    divergence = grid_field()
+    pressure, residual = grid_field(sparse=False), grid_field(sparse=False)
+    multigrid = Multigrid((width, height), residual=residual, sparse=args.sparse)
+    conjugate_gradient = ConjugateGradient((width, height), args.preconditioner) if args.solver == "pcg" else None
+    advection = Advection(args.advection)
+    corrected = args.sparse and args.advection != "semi-lagrangian"
+    backward_velocity, backward_dye = (grid_field(2), grid_field()) if corrected else (None, None)
+
+    def advect(dt):
+        global velocity, new_velocity, dye, new_dye
+        # dye first, it moves with the velocity from before the advection
+        advection.advect(velocity, dye, new_dye, dt, backward_dye)
+        advection.advect(velocity, velocity, new_velocity, dt, backward_velocity)
+        velocity, new_velocity = new_velocity, velocity
+        dye, new_dye = new_dye, dye
+
+    def field_memory():
+        # bytes of cell data; the sparse fields only hold the active blocks
+        def cell_bytes(fields):
+            return sum(4 * getattr(field, "n", 1) for field in fields)
+        active_cells = active_blocks * block_size ** 2 if args.sparse else 0
+        return active_cells * cell_bytes(sparse_fields) + width * height * cell_bytes(dense_fields)
+
+    def divergence_scale(solver):
+        # 1.9 makes up for part of what the 20 Gauss-Seidel launches leave unsolved;
+        # with a converged pressure it would make the divergence flip sign every frame
+        return 1.9 if solver == "gauss-seidel" else 1.0
+
+    def solve_pressure(solver):
+        # multigrid and pcg start from the pressure of the previous frame
+        if solver == "multigrid":
+            cycles, residual = multigrid.solve(pressure, divergence, args.tolerance)
+            if args.log:
+                print(f"cycles {cycles} residual {residual:.3e}")
+        elif solver == "pcg":
+            iterations, residual = conjugate_gradient.solve(pressure, divergence, args.tolerance, log=args.log)
+            if args.log:
+                print(f"iterations {iterations} residual {residual:.3e}")
+        else:
+            pressure.fill(0.0)
+            for i in range(20):
+                compute_pressure(parity=i%2)
+
+    active_blocks = 0
+
+    def step(frame, solver):
+        global active_blocks
+        if args.sparse:
+            mark_blocks(dye, args.dye_threshold)
+            active_blocks = update_blocks()
         emitter_pos = ti.Vector([0.5 + np.sin(frame * 0.04) * 0.2, 0.7])
-        add_force(emitter_pos)
+        add_force(velocity, dye, emitter_pos)
+        advect(0.05)
+        compute_divergence(velocity, divergence_scale(solver))
+        solve_pressure(solver)
+        subtract_pressure_gradient(velocity)
+
+    if args.benchmark == "advection":
+        # a steady vortex with a disk of dye inside its core: the enstrophy and the integral of dye^2
+        # stay constant in the exact flow, what they lose is numerical diffusion
+        center, steps, dt = ti.Vector([0.5, 0.5]), 100, 0.05
+        print(f"{width}x{height}, {steps} steps")
+        print(f"{'advection':>16} {'velocity + dye [ms]':>20} {'enstrophy':>10} {'dye^2':>8}")
+        for mode in Advection.modes:
+            advection = Advection(mode)
+            for _ in range(2):  # compile the kernels for both buffer orders
+                advect(dt)
+            velocity.fill(0.0)
+            add_vortex(velocity, center, 0.05, 0.02)
+            dye.fill(0.0)
+            add_disk(dye, center + ti.Vector([0.02, 0.0]), 0.03)
+            pressure.fill(0.0)
+            initial_enstrophy, initial_dye = enstrophy(velocity), float(np.sum(dye.to_numpy() ** 2))
+            elapsed = 0.0
+            for _ in range(steps):
+                start = time.perf_counter()
+                advect(dt)
+                ti.sync()
+                elapsed += time.perf_counter() - start
+                compute_divergence(velocity, divergence_scale("multigrid"))
+                multigrid.solve(pressure, divergence, 1e-4)
+                subtract_pressure_gradient(velocity)
+            print(f"{mode:>16} {elapsed / steps * 1e3:>20.2f} {enstrophy(velocity) / initial_enstrophy:>10.1%}"
+                  f" {np.sum(dye.to_numpy() ** 2) / initial_dye:>8.1%}")
+        exit()
+
+    if args.benchmark == "pressure":
+        # a developed flow, then the pressure system of the next frame from a cold and a warm start
+        for frame in range(100):
+            step(frame, "multigrid")
+        previous_pressure = pressure.to_numpy()
+        add_force(velocity, dye, ti.Vector([0.5 + np.sin(100 * 0.04) * 0.2, 0.7]))
         advect(0.05)
-        compute_divergence()
-        pressure.fill(0.0)
-        for i in range(20):
-            compute_pressure(parity=i%2)
-        subtract_pressure_gradient()
-        render()
-
-        canvas.set_image(colors)
-        window.show()
+        compute_divergence(velocity, divergence_scale("multigrid"))
+        print(f"{'solver':>24} {'time [ms]':>10} {'residual':>10}")
+
+        def report(name, start):
+            ti.sync()
+            elapsed = time.perf_counter() - start
+            print(f"{name:>24} {elapsed * 1e3:>10.2f} {multigrid.relative_residual(pressure, divergence):>10.2e}")
+
+        for parity in range(2):  # compile
+            compute_pressure(parity)
+        for sweeps in [20, 100, 500, 2000]:
+            pressure.fill(0.0)
+            start = time.perf_counter()
+            for i in range(sweeps):
+                compute_pressure(parity=i%2)
+            report(f"gauss-seidel x{sweeps}", start)
+        for name, initial_pressure in [("cold", np.zeros_like(previous_pressure)), ("warm", previous_pressure)]:
+            pressure.from_numpy(initial_pressure)
+            print(f"{'multigrid, ' + name:>24} {'':>10} {multigrid.relative_residual(pressure, divergence):>10.2e}")
+            start = time.perf_counter()
+            for cycle in range(1, 7):
+                multigrid.solve(pressure, divergence, tolerance=0.0, max_cycles=1)
+                report(f"{cycle} cycles", start)
+        exit()
+
+    writer = FrameWriter(args.record) if args.record else None
+    frame = 0
+    peak_memory = 0
+    while frame < args.frames if args.frames else window.running:
+        if frame == 2:  # the kernels are compiled for both buffer orders
+            ti.sync()
+            start = interval_start = time.perf_counter()
+        step(frame, args.solver)
+        peak_memory = max(peak_memory, field_memory())
+        if args.frames and frame % 50 == 49:
+            ti.sync()
+            now = time.perf_counter()
+            frames = 50 if frame > 50 else 48
+            print(f"frames {frame - frames + 2}-{frame + 1}: {(now - interval_start) / frames * 1e3:.2f} ms/frame,"
+                  f" field memory {field_memory() / 2 ** 20:.1f} MiB")
+            interval_start = now
+        if writer:
+            writer.write(velocity=velocity, pressure=pressure, dye=dye)
+        if not headless:
+            render(velocity, dye)
+            canvas.set_image(colors)
+            window.show()
         frame += 1
+    if writer:
+        writer.close()
+    if args.frames > 2:
+        ti.sync()
+        print(f"{(time.perf_counter() - start) / (args.frames - 2) * 1e3:.2f} ms/frame,"
+              f" field memory {field_memory() / 2 ** 20:.1f} MiB, peak {peak_memory / 2 ** 20:.1f} MiB")
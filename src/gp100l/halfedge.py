@@ -1,60 +1,141 @@
-import taichi as ti
+import argparse
+import itertools
 import math
+import time
+import numpy as np
+import taichi as ti
+from bench_util import measure
+
+
+class HalfEdgeMesh:
+    # The connectivity as arrays, -1 where there is no element (the twin of a boundary edge).
+    # Half-edges of face f are face_edge[f], face_edge[f] + 1, ... in the order of its vertices.
+    # vertex.position returns a copy of the row in positions: write vertex.position = p, an in-place
+    # change like vertex.position.x += 1 is lost.
+    def __init__(self, vertex_positions, face_indices):
+        self.positions = np.asarray(vertex_positions, dtype=np.float32).reshape(-1, 3)
+        if isinstance(face_indices, np.ndarray) and face_indices.ndim == 2:
+            sizes = np.full(len(face_indices), face_indices.shape[1], dtype=np.int32)
+            self.origin = face_indices.astype(np.int32).ravel()
+        else:  # a list of polygons of any size
+            sizes = np.fromiter(map(len, face_indices), dtype=np.int32, count=len(face_indices))
+            self.origin = np.fromiter(itertools.chain.from_iterable(face_indices), dtype=np.int32, count=sizes.sum())
+        num_edges = len(self.origin)
+        self.face_edge = (np.cumsum(sizes, dtype=np.int32) - sizes).astype(np.int32)
+        self.face = np.repeat(np.arange(len(sizes), dtype=np.int32), sizes)
+        edge = np.arange(num_edges, dtype=np.int32)
+        first = self.face_edge[self.face]
+        last = first + sizes[self.face] - 1
+        self.next = np.where(edge == last, first, edge + 1).astype(np.int32)
+        self.prev = np.where(edge == first, last, edge - 1).astype(np.int32)
+        # the last half-edge leaving each vertex
+        self.vertex_edge = np.full(len(self.positions), -1, dtype=np.int32)
+        vertices, last_in_reverse = np.unique(self.origin[::-1], return_index=True)
+        self.vertex_edge[vertices] = num_edges - 1 - last_in_reverse
+        self.twin = self.link_twins()
+        # the object API
+        self.vertices = Elements(self, Vertex, len(self.positions))
+        self.faces = Elements(self, Face, len(sizes))
+        self.edges = Elements(self, HalfEdge, num_edges)
+
+    def link_twins(self):
+        # sorting by the packed (min, max) vertex pair puts the two half-edges of an edge next to each
+        # other. Pairs with the same direction and edges of more than two faces are not linked.
+        destination = self.origin[self.next]
+        low = np.minimum(self.origin, destination).astype(np.int64)
+        high = np.maximum(self.origin, destination).astype(np.int64)
+        keys = low * len(self.positions) + high
+        order = np.argsort(keys, kind="stable").astype(np.int32)
+        keys = np.concatenate([[-1], keys[order], [-1]])
+        pair = (keys[1:-2] == keys[2:-1]) & (keys[:-3] != keys[1:-2]) & (keys[3:] != keys[2:-1])
+        first, second = order[:-1][pair], order[1:][pair]
+        opposite = self.origin[first] == destination[second]
+        first, second = first[opposite], second[opposite]
+        twin = np.full(len(self.origin), -1, dtype=np.int32)
+        twin[first] = second
+        twin[second] = first
+        return twin
+
+    def line_indices(self, unique=True):
+        # vertex pairs for scene.lines, each edge once or line e for half-edge e
+        edges = np.flatnonzero((self.twin == -1) | (np.arange(len(self.twin)) < self.twin)) if unique else slice(None)
+        return np.stack([self.origin[edges], self.origin[self.next[edges]]], axis=-1).ravel()
+
+    def nbytes(self):
+        return sum(array.nbytes for array in [self.positions, self.origin, self.face, self.twin, self.next,
+                                              self.prev, self.vertex_edge, self.face_edge])
+
+
+class Elements:
+    # a list-like view of the vertices, faces or half-edges of a HalfEdgeMesh
+    def __init__(self, mesh, view, count):
+        self.mesh = mesh
+        self.view = view
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.view(self.mesh, i) for i in range(self.count)[index]]
+        return self.view(self.mesh, range(self.count)[index])
+
+    def __iter__(self):
+        return (self.view(self.mesh, index) for index in range(self.count))
 
 
 class Vertex:
-    def __init__(self, position, edge=-1):
-        self.position = position
-        self.edge = edge
+    __slots__ = ["mesh", "index"]
+
+    def __init__(self, mesh, index):
+        self.mesh = mesh
+        self.index = index
+
+    @property
+    def position(self):  # a copy, assign to change it
+        return ti.Vector(self.mesh.positions[self.index])
+
+    @position.setter
+    def position(self, position):
+        self.mesh.positions[self.index] = position
+
+    @property
+    def edge(self):
+        return int(self.mesh.vertex_edge[self.index])
+
+    @edge.setter
+    def edge(self, edge):
+        self.mesh.vertex_edge[self.index] = edge
 
 
 class HalfEdge:
-    def __init__(self, origin, face=-1, twin=-1, next=-1, prev=-1):
-        self.origin = origin
-        self.face = face
-        self.twin = twin
-        self.next = next
-        self.prev = prev
+    __slots__ = ["mesh", "index"]
+
+    def __init__(self, mesh, index):
+        self.mesh = mesh
+        self.index = index
+
+    origin = property(lambda self: int(self.mesh.origin[self.index]))
+    face = property(lambda self: int(self.mesh.face[self.index]))
+    twin = property(lambda self: int(self.mesh.twin[self.index]))
+    next = property(lambda self: int(self.mesh.next[self.index]))
+    prev = property(lambda self: int(self.mesh.prev[self.index]))
 
 
 class Face:
-    def __init__(self, edge):
-        self.edge = edge
+    __slots__ = ["mesh", "index"]
+
+    def __init__(self, mesh, index):
+        self.mesh = mesh
+        self.index = index
+
+    edge = property(lambda self: int(self.mesh.face_edge[self.index]))
 
 
 def build_half_edges(vertex_positions, face_indices):
-    vertices = []
-    faces = []
-    edges = []
-    for pos in vertex_positions:
-        vertices.append(Vertex(pos))
-
-    for f, indices in enumerate(face_indices):
-        num_vertices = len(indices)
-        edge_offset = len(edges)
-        for i, v in enumerate(indices):
-            edges.append(HalfEdge(v, f))
-            vertices[v].edge = edge_offset + i
-
-        for i in range(num_vertices):
-            edges[edge_offset + i].next = edge_offset + (i + 1) % num_vertices
-            edges[edge_offset + i].prev = edge_offset + (i - 1) % num_vertices
-
-        faces.append(Face(edge_offset))
-
-    for ei1 in range(len(edges)):  # search twins
-        ei2 = edges[ei1].next
-        vi1 = edges[ei1].origin
-        vi2 = edges[ei2].origin
-        for ej1 in range(ei1, len(edges)):
-            ej2 = edges[ej1].next
-            vj1 = edges[ej1].origin
-            vj2 = edges[ej2].origin
-            if vi1 == vj2 and vi2 == vj1:
-                edges[ei1].twin = ej1
-                edges[ej1].twin = ei1
-
-    return vertices, faces, edges
+    mesh = HalfEdgeMesh(vertex_positions, face_indices)
+    return mesh.vertices, mesh.faces, mesh.edges
 
 
 def convert_to_vertex_field(vertices):
@@ -65,7 +146,7 @@ def convert_to_vertex_field(vertices):
 
 
 def convert_to_line_index_field(edges):
-    line_index_field = ti.field(int, shape=len(edges*2))
+    line_index_field = ti.field(int, shape=len(edges) * 2)
     index = 0
     for i in range(len(edges)):
         e1 = i
@@ -80,7 +161,236 @@ def convert_to_line_index_field(edges):
     return line_index_field
 
 
+class MeshFields:
+    # the fields scene.particles and scene.lines take, each filled with one from_numpy.
+    # update() reuses them when only the positions changed; make new ones when the topology does.
+    def __init__(self, mesh, unique_edges=True):
+        self.vertices = ti.Vector.field(3, dtype=float, shape=len(mesh.positions))
+        indices = mesh.line_indices(unique_edges)
+        self.line_indices = ti.field(ti.i32, shape=len(indices))
+        self.line_indices.from_numpy(indices)
+        self.update(mesh)
+
+    def update(self, mesh):
+        self.vertices.from_numpy(mesh.positions)
+
+
+@ti.data_oriented
+class HalfEdgeFields:
+    # The connectivity of a HalfEdgeMesh in Taichi fields, for kernels that run over all vertices or
+    # faces in parallel. A face loop or a vertex one-ring is walked with a cursor:
+    #
+    #   e = self.first_around_vertex(v)
+    #   while e != -1:
+    #       ...                             # e leaves v
+    #       e = self.next_around_vertex(v, e)
+    #
+    # The one-ring visits the half-edges leaving v, one per face around v. At a boundary vertex it
+    # starts after the boundary, so it sees all faces, and boundary_neighbor(v) is the neighbor
+    # reached only by the incoming boundary half-edge. Vertices with several boundary fans
+    # (non-manifold) are walked for one fan.
+    def __init__(self, mesh):
+        num_vertices, num_faces, num_edges = len(mesh.positions), len(mesh.face_edge), len(mesh.origin)
+        self.positions = ti.Vector.field(3, dtype=float, shape=num_vertices)
+        self.origin = ti.field(ti.i32, shape=num_edges)
+        self.face = ti.field(ti.i32, shape=num_edges)
+        self.twin = ti.field(ti.i32, shape=num_edges)
+        self.next = ti.field(ti.i32, shape=num_edges)
+        self.prev = ti.field(ti.i32, shape=num_edges)
+        self.vertex_edge = ti.field(ti.i32, shape=num_vertices)
+        self.face_edge = ti.field(ti.i32, shape=num_faces)
+        for name in ["origin", "face", "twin", "next", "prev", "face_edge"]:
+            getattr(self, name).from_numpy(getattr(mesh, name))
+        # start one-rings after the boundary: at the half-edge that follows an incoming boundary one
+        vertex_edge = mesh.vertex_edge.copy()
+        after_boundary = mesh.next[mesh.twin == -1]
+        vertex_edge[mesh.origin[after_boundary]] = after_boundary
+        self.vertex_edge.from_numpy(vertex_edge)
+        self.update(mesh)
+        # results of the kernels below
+        self.valence = ti.field(ti.i32, shape=num_vertices)
+        self.centroids = ti.Vector.field(3, dtype=float, shape=num_faces)
+        self.normals = ti.Vector.field(3, dtype=float, shape=num_vertices)
+
+    def update(self, mesh):
+        # new positions, same topology
+        self.positions.from_numpy(mesh.positions)
+
+    @ti.func
+    def destination(self, e):
+        return self.origin[self.next[e]]
+
+    @ti.func
+    def first_around_face(self, f):
+        return self.face_edge[f]
+
+    @ti.func
+    def next_around_face(self, f, e):
+        e = self.next[e]
+        if e == self.face_edge[f]:
+            e = -1
+        return e
+
+    @ti.func
+    def first_around_vertex(self, v):
+        return self.vertex_edge[v]
+
+    @ti.func
+    def next_around_vertex(self, v, e):
+        twin = self.twin[e]
+        e = -1
+        if twin != -1:
+            e = self.next[twin]
+            if e == self.vertex_edge[v]:
+                e = -1
+        return e
+
+    @ti.func
+    def boundary_neighbor(self, v):
+        neighbor = -1
+        first = self.vertex_edge[v]
+        if first != -1 and self.twin[self.prev[first]] == -1:
+            neighbor = self.origin[self.prev[first]]
+        return neighbor
+
+    @ti.kernel
+    def compute_valence(self):
+        # number of edges at each vertex
+        for v in self.valence:
+            count = 0
+            e = self.first_around_vertex(v)
+            while e != -1:
+                count += 1
+                e = self.next_around_vertex(v, e)
+            if self.boundary_neighbor(v) != -1:
+                count += 1
+            self.valence[v] = count
+
+    @ti.kernel
+    def compute_centroids(self):
+        # average of the vertices of each face
+        for f in self.centroids:
+            total = ti.Vector([0.0, 0.0, 0.0])
+            count = 0
+            e = self.first_around_face(f)
+            while e != -1:
+                total += self.positions[self.origin[e]]
+                count += 1
+                e = self.next_around_face(f, e)
+            self.centroids[f] = total / count
+
+    @ti.kernel
+    def compute_normals(self):
+        # sum of the cross products of the two edges at each corner around the vertex, which weights
+        # the faces by area (exactly for triangles)
+        for v in self.normals:
+            normal = ti.Vector([0.0, 0.0, 0.0])
+            p = self.positions[v]
+            e = self.first_around_vertex(v)
+            while e != -1:
+                to_next = self.positions[self.destination(e)] - p
+                to_prev = self.positions[self.origin[self.prev[e]]] - p
+                normal += ti.math.cross(to_next, to_prev)
+                e = self.next_around_vertex(v, e)
+            self.normals[v] = normal.normalized(1e-12)
+
+    @ti.kernel
+    def one_ring_average(self, values: ti.template(), result: ti.template()):
+        # result[v] = mean of values over the neighbors of v, e.g. one step of Laplacian smoothing
+        for v in result:
+            total = values[v] * 0
+            count = 0
+            e = self.first_around_vertex(v)
+            while e != -1:
+                total += values[self.destination(e)]
+                count += 1
+                e = self.next_around_vertex(v, e)
+            neighbor = self.boundary_neighbor(v)
+            if neighbor != -1:
+                total += values[neighbor]
+                count += 1
+            result[v] = values[v]
+            if count > 0:
+                result[v] = total / count
+
+
+def grid_mesh(n):
+    # n x n quads in the unit square
+    i, j = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="ij")
+    positions = np.stack([i / n, j / n, np.zeros_like(i)], axis=-1).reshape(-1, 3)
+    v = (np.arange(n)[:, None] * (n + 1) + np.arange(n)).ravel()
+    return positions, np.stack([v, v + n + 1, v + n + 2, v + 1], axis=-1)
+
+
+def centroids_per_element(mesh):
+    centroids = []
+    for face in mesh.faces:
+        total = ti.Vector([0.0, 0.0, 0.0])
+        count = 0
+        e = face.edge
+        while True:
+            total += mesh.vertices[mesh.edges[e].origin].position
+            count += 1
+            e = mesh.edges[e].next
+            if e == face.edge:
+                break
+        centroids.append(total / count)
+    return centroids
+
+
+def benchmark():
+    # build, then the upload of vertices and lines element by element, in bulk, and of new positions
+    ti.init(arch=ti.cpu)
+    MeshFields(HalfEdgeMesh(*grid_mesh(1)))  # compile from_numpy
+    print(f"{'faces':>9} {'half-edges':>10} {'build [s]':>9} {'arrays [MiB]':>12}"
+          f" {'per element [s]':>15} {'bulk [s]':>9} {'positions [s]':>13}")
+    for n in [100, 316, 1000]:
+        positions, face_indices = grid_mesh(n)
+        start = time.perf_counter()
+        mesh = HalfEdgeMesh(positions, face_indices)
+        build = time.perf_counter() - start
+        per_element = "-"
+        if n < 1000:  # minutes at 1M faces
+            start = time.perf_counter()
+            convert_to_vertex_field(mesh.vertices)
+            convert_to_line_index_field(mesh.edges)
+            ti.sync()
+            per_element = f"{time.perf_counter() - start:.3f}"
+        start = time.perf_counter()
+        fields = MeshFields(mesh)
+        ti.sync()
+        bulk = time.perf_counter() - start
+        start = time.perf_counter()
+        fields.update(mesh)
+        ti.sync()
+        update = time.perf_counter() - start
+        print(f"{len(mesh.faces):>9} {len(mesh.edges):>10} {build:>9.3f} {mesh.nbytes() / 2 ** 20:>12.1f}"
+              f" {per_element:>15} {bulk:>9.3f} {update:>13.4f}")
+    # face centroids walking the face loops in Python, and the kernels of HalfEdgeFields
+    print(f"{'faces':>9} {'centroids, python [s]':>21} {'centroids [s]':>13} {'valence [s]':>11}"
+          f" {'normals [s]':>11} {'one-ring [s]':>12}")
+    for n in [100, 316, 1000]:
+        mesh = HalfEdgeMesh(*grid_mesh(n))
+        python = "-"
+        if n < 1000:
+            start = time.perf_counter()
+            centroids_per_element(mesh)
+            python = f"{time.perf_counter() - start:.3f}"
+        fields = HalfEdgeFields(mesh)
+        smoothed = ti.Vector.field(3, dtype=float, shape=len(mesh.positions))
+        times = [measure(kernel) for kernel in [fields.compute_centroids, fields.compute_valence, fields.compute_normals,
+                                                lambda: fields.one_ring_average(fields.positions, smoothed)]]
+        print(f"{len(mesh.faces):>9} {python:>21}" + "".join(f" {t:>{w}.4f}" for t, w in zip(times, [13, 11, 11, 12])))
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", help="print build, upload and traversal times of grid meshes up to 1M faces")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+        exit()
+
     ti.init(arch=ti.vulkan)
     window = ti.ui.Window("Half-Edge", (1024, 1024), vsync=True)
     canvas = window.get_canvas()
@@ -101,9 +411,10 @@ if __name__ == '__main__':
         face_indices.append([0, i + 1, ((i + 1) % num) + 1])
 
     # build half edges
-    vertices, faces, edges = build_half_edges(vertex_positions, face_indices)
-    vertex_field = convert_to_vertex_field(vertices)
-    line_index_field = convert_to_line_index_field(edges)
+    mesh = HalfEdgeMesh(vertex_positions, face_indices)
+    vertices, faces, edges = mesh.vertices, mesh.faces, mesh.edges
+    fields = MeshFields(mesh, unique_edges=False)  # line e is half-edge e, for the highlighted ones
+    vertex_field, line_index_field = fields.vertices, fields.line_indices
     print("num vertices:", len(vertices))
     print("num faces:", len(faces))
     print("num edges:", len(edges))
@@ -0,0 +1,227 @@
+# Geometric multigrid for the pressure Poisson equation of the grid fluids
+# Solves sum(x[neighbors]) - 2 * dim * x = b, the system that compute_pressure in grid_fluid.py relaxes,
+# with x = 0 on the outermost ring of cells. Works for 2D and 3D fields.
+# Each V-cycle smooths with red-black Gauss-Seidel, restricts the residual to a grid with half the
+# resolution, solves there recursively and adds the bilinearly interpolated correction back.
+# Coarse levels are cell-centered: coarse cell I covers fine cells 2I and 2I + 1 along every axis.
+# The cycle is a symmetric operator (restriction is the transpose of the interpolation, smoothing
+# after the coarse correction runs the colors in reverse), so it also serves as a CG preconditioner.
+#
+#   multigrid = Multigrid(pressure.shape)
+#   cycles, residual = multigrid.solve(pressure, divergence, tolerance=1e-3)
+
+import taichi as ti
+
+
+@ti.data_oriented
+class Multigrid:
+    def __init__(self, shape, smooth_sweeps=2, coarsest_size=4, coarsest_sweeps=32, dtype=float, residual=None, sparse=False):
+        self.dim = len(shape)
+        self.smooth_sweeps = smooth_sweeps
+        self.coarsest_sweeps = coarsest_sweeps
+        # level 0 uses the fields passed to solve(), the coarser ones have their own
+        self.shapes = [tuple(shape)]
+        while min(self.shapes[-1]) > coarsest_size:
+            self.shapes.append(tuple((n + 1) // 2 for n in self.shapes[-1]))
+        self.x = [None] + [ti.field(dtype=dtype, shape=s) for s in self.shapes[1:]]
+        self.b = [None] + [ti.field(dtype=dtype, shape=s) for s in self.shapes[1:]]
+        # the finest residual can be given, e.g. a field next to the pressure. The kernels of the finest
+        # level visit the cells of b: with a sparse b only its active cells are unknowns, and x and the
+        # residual are 0 in the others, which may be dense fields as long as they are kept 0 there
+        self.r = [residual] + [ti.field(dtype=dtype, shape=s) for s in self.shapes[1:-1]]
+        if residual is None and len(self.shapes) > 1:
+            self.r[0] = ti.field(dtype=dtype, shape=self.shapes[0])
+        # with sparse fields, a coarse cell is only an unknown if all the cells it covers are; the others
+        # are boundary like the cells outside the field. A coarse cell over a few unknowns would give them
+        # the correction of a whole cell, and the cycles would stall.
+        self.sparse = sparse
+        if sparse:
+            self.active = [None] + [ti.field(dtype=ti.i8, shape=s) for s in self.shapes[1:]]
+
+    @ti.func
+    def neighbor_sum(self, x: ti.template(), I):
+        total = ti.cast(0.0, x.dtype)
+        for k in ti.static(range(self.dim)):
+            offset = ti.Vector.unit(self.dim, k, int)
+            if I[k] > 0:
+                total += x[I - offset]
+            if I[k] < x.shape[k] - 1:
+                total += x[I + offset]
+        return total
+
+    @ti.func
+    def diagonal(self, x: ti.template(), I, level: ti.template()):
+        # cells outside the field mirror x with the opposite sign, which puts the x = 0 boundary
+        # on the outer faces of the coarse grids instead of half a coarse cell further out. Next to the
+        # inactive cells of a sparse field the 0 is at the center of the first inactive fine cell,
+        # (s + 1) / 2s coarse cells out for s fine cells per coarse cell, where a linear ghost value
+        # adds (s - 1) / (s + 1); the mirror's 1 takes one more cycle to converge.
+        diagonal = 2.0 * self.dim
+        for k in ti.static(range(self.dim)):
+            offset = ti.Vector.unit(self.dim, k, int)
+            if I[k] == 0:
+                diagonal += 1.0
+            elif ti.static(self.sparse and level > 0):
+                if self.active[level][I - offset] == 0:
+                    diagonal += ti.static((2 ** level - 1) / (2 ** level + 1))
+            if I[k] == x.shape[k] - 1:
+                diagonal += 1.0
+            elif ti.static(self.sparse and level > 0):
+                if self.active[level][I + offset] == 0:
+                    diagonal += ti.static((2 ** level - 1) / (2 ** level + 1))
+        return diagonal
+
+    @ti.func
+    def is_inside(self, x: ti.template(), I):
+        inside = True
+        for k in ti.static(range(self.dim)):
+            if I[k] < 0 or I[k] >= x.shape[k]:
+                inside = False
+        return inside
+
+    @ti.func
+    def is_unknown(self, x: ti.template(), I, level: ti.template()):
+        # on the finest level the outermost ring is the x = 0 boundary
+        inside = True
+        if ti.static(self.sparse and level > 0):
+            inside = self.active[level][I] != 0
+        if ti.static(level == 0):
+            for k in ti.static(range(self.dim)):
+                if I[k] == 0 or I[k] == x.shape[k] - 1:
+                    inside = False
+        return inside
+
+    @ti.kernel
+    def sweep(self, x: ti.template(), b: ti.template(), level: ti.template(), reverse: ti.template()):
+        # one red-black Gauss-Seidel sweep, both colors in one launch
+        for parity in ti.static((1, 0) if reverse else (0, 1)):
+            for I in ti.grouped(b):
+                if I.sum() % 2 == parity and self.is_unknown(x, I, level):
+                    x[I] = (self.neighbor_sum(x, I) - b[I]) / self.diagonal(x, I, level)
+
+    def smooth(self, x, b, level, sweeps, reverse=False):
+        for _ in range(sweeps):
+            self.sweep(x, b, level, reverse)
+
+    @ti.kernel
+    def residual(self, x: ti.template(), b: ti.template(), r: ti.template(), level: ti.template()) -> ti.f64:
+        # writes r = b - A x and returns its squared norm
+        norm = ti.f64(0.0)
+        for I in ti.grouped(b):
+            value = ti.cast(0.0, r.dtype)
+            if self.is_unknown(x, I, level):
+                value = b[I] - (self.neighbor_sum(x, I) - self.diagonal(x, I, level) * x[I])
+            r[I] = value
+            norm += ti.f64(value) ** 2
+        return norm
+
+    @ti.kernel
+    def norm(self, b: ti.template(), level: ti.template()) -> ti.f64:
+        norm = ti.f64(0.0)
+        for I in ti.grouped(b):
+            if self.is_unknown(b, I, level):
+                norm += ti.f64(b[I]) ** 2
+        return norm
+
+    @ti.func
+    def restrict_taps(self, r: ti.template(), I, lead, lead_weight):
+        # the 4 x 4 taps of restrict along the last two axes, lead are the offsets along the others
+        total = ti.cast(0.0, r.dtype)
+        for offset in ti.static(ti.grouped(ti.ndrange(4, 4))):
+            J = 2 * I - 1 + ti.Vector(lead + [offset[0], offset[1]])
+            weight = lead_weight
+            for k in ti.static(range(2)):
+                weight *= 0.75 if 0 < offset[k] < 3 else 0.25
+            if self.is_inside(r, J):
+                total += weight * r[J]
+        return total
+
+    @ti.kernel
+    def restrict(self, r: ti.template(), b: ti.template(), x: ti.template(), level: ti.template()):
+        # transpose of prolongate: fine cells 2I - 1 ... 2I + 2 with weights 1/4, 3/4, 3/4, 1/4 per axis.
+        # The weights sum to 2^dim and the coarse operator has twice the grid spacing, hence 4 / 2^dim.
+        # The taps are unrolled in nested loops of 4 and 4 x 4: one static loop over all 64 in 3D is over
+        # Taichi's unrolling limit, and a runtime loop over the first axis makes restrict 20% slower.
+        # Coarse boundary cells skip the taps, which in a sparse r mostly miss the allocated blocks.
+        for I in ti.grouped(b):
+            total = ti.cast(0.0, b.dtype)
+            if self.is_unknown(b, I, level):
+                if ti.static(self.dim == 3):
+                    for a in ti.static(range(4)):
+                        total += self.restrict_taps(r, I, [a], 0.75 if 0 < a < 3 else 0.25)
+                else:
+                    total = self.restrict_taps(r, I, [], 1.0)
+            b[I] = total * 4.0 / 2 ** self.dim
+            x[I] = 0.0
+
+    @ti.kernel
+    def prolongate(self, coarse: ti.template(), x: ti.template(), b: ti.template(), level: ti.template()):
+        # bilinear (trilinear) interpolation between the centers of the coarse cells
+        for I in ti.grouped(b):
+            if self.is_unknown(x, I, level):
+                base = I // 2
+                side = 2 * (I % 2) - 1
+                correction = ti.cast(0.0, x.dtype)
+                for corner in ti.static(ti.grouped(ti.ndrange(*([2] * self.dim)))):
+                    J = base + corner * side
+                    weight = 1.0
+                    for k in ti.static(range(self.dim)):
+                        weight *= 0.75 - 0.5 * corner[k]
+                    if self.is_inside(coarse, J):
+                        correction += weight * coarse[J]
+                x[I] += correction
+
+    def v_cycle(self, level=0):
+        x, b = self.x[level], self.b[level]
+        if level == len(self.shapes) - 1:
+            self.smooth(x, b, level, self.coarsest_sweeps // 2)
+            self.smooth(x, b, level, self.coarsest_sweeps // 2, reverse=True)
+            return
+        self.smooth(x, b, level, self.smooth_sweeps)
+        self.residual(x, b, self.r[level], level)
+        self.restrict(self.r[level], self.b[level + 1], self.x[level + 1], level + 1)
+        self.v_cycle(level + 1)
+        self.prolongate(self.x[level + 1], x, b, level)
+        self.smooth(x, b, level, self.smooth_sweeps, reverse=True)
+
+    @ti.kernel
+    def coarsen_active(self, fine: ti.template(), active: ti.template()):
+        # clears the coarse cells over a boundary cell of the level below, or marks those over an active
+        # cell of the sparse fine field, whose blocks are aligned to coarse cells
+        for I in ti.grouped(fine):
+            if ti.static(fine.dtype == ti.i8):
+                if fine[I] == 0:
+                    active[I // 2] = ti.i8(0)
+            else:
+                active[I // 2] = ti.i8(1)
+
+    def update_active(self, b):
+        for level in range(1, len(self.shapes)):
+            self.active[level].fill(0 if level == 1 else 1)
+            self.coarsen_active(b if level == 1 else self.active[level - 1], self.active[level])
+
+    def precondition(self, r, z):
+        # z = one V-cycle applied to r from z = 0, a fixed symmetric approximation of A^-1 r
+        self.x[0], self.b[0] = z, r
+        z.fill(0.0)
+        if self.sparse:
+            self.update_active(r)
+        self.v_cycle()
+
+    def relative_residual(self, x, b):
+        # |b - A x| / |b|
+        return (self.residual(x, b, self.r[0], 0) / max(self.norm(b, 0), 1e-60)) ** 0.5
+
+    def solve(self, x, b, tolerance=1e-3, max_cycles=20):
+        # V-cycles until |b - A x| <= tolerance * |b|, starting from the current x (warm start).
+        # Returns the number of cycles and the relative residual.
+        self.x[0], self.b[0] = x, b
+        if self.sparse:
+            self.update_active(b)
+        residual = self.relative_residual(x, b)
+        cycles = 0
+        while residual > tolerance and cycles < max_cycles:
+            self.v_cycle()
+            residual = self.relative_residual(x, b)
+            cycles += 1
+        return cycles, residual
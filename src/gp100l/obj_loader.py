@@ -1,3 +1,4 @@
+import numpy as np
 import taichi as ti
 
 
@@ -21,3 +22,17 @@ def load_obj(file_path):
             indices.append(v)
         face_indices.append(indices)
     return vertex_positions, face_indices
+
+
+def load_obj_triangles(file_path):
+    with open(file_path) as f:
+        lines = f.readlines()
+
+    vertex_positions = np.array([line.split()[1:4] for line in lines if line.startswith('v ')], dtype=np.float32)
+
+    triangle_indices = []
+    for line in [line for line in lines if line.startswith('f ')]:
+        indices = [int(val.split("/")[0]) - 1 for val in line.split()[1:]]
+        for i in range(1, len(indices) - 1):  # fan triangulation of quads and n-gons
+            triangle_indices.append((indices[0], indices[i], indices[i + 1]))
+    return vertex_positions, np.array(triangle_indices, dtype=np.int32).reshape(-1, 3)
@@ -1,18 +1,15 @@
+import argparse
+import time
+import numpy as np
 import taichi as ti
 import math
-
-
-@ti.kernel
-def initialize():
-    for i in ti.grouped(positions):
-        positions[i].x = ti.random(float) * 0.1 + 0.1
-        positions[i].y = ti.random(float) * 0.1 + 0.8
-        velocities[i] = [0.02, -0.01]
+from frame_store import FrameWriter
 
 
 @ti.func
 def spline_kernel(r, h):
-    q = ti.math.length(r) / h
+    # h is a per-simulation value, the reciprocal keeps the division out of the neighbor loops
+    q = ti.math.length(r) * (1.0 / h)
     alpha = 10.0 / (7.0 * math.pi * h**2)
     value = 0.0
     if 0.0 <= q <= 1.0:
@@ -24,7 +21,7 @@ def spline_kernel(r, h):
 
 @ti.func
 def spline_kernel_gradient(r, h):
-    q = ti.math.length(r) / h
+    q = ti.math.length(r) * (1.0 / h)
     alpha = 45.0 / (14.0 * math.pi * h**4)
     value = ti.math.vec2(0.0)
     if 0.0 <= q <= 1.0:
@@ -34,65 +31,481 @@ def spline_kernel_gradient(r, h):
     return value
 
 
-@ti.kernel
-def update(num_active_particles: int):
-    mass = 1.0
-    for i in range(num_active_particles):
-        # Compute density
-        density = 0.0
-        for j in range(num_active_particles):
-            density += mass * spline_kernel(positions[i] - positions[j], radius)
-        densities[i] = density
-
-        # Compute pressure
-        stiffness = 0.00007
-        pressures[i] = max(stiffness * densities[i], 0.0)
-
-    for i in range(num_active_particles):
-        # Compute force
-        force = ti.math.vec2(0.0)
-        force.y -= 0.98  # gravity
-        for j in range(num_active_particles):
-            pi = pressures[i]
-            pj = pressures[j]
-            grad = spline_kernel_gradient(positions[i] - positions[j], radius)
-            force -= mass / densities[j] * (pi + pj) / 2.0 * grad
-
-        # Compute acceleration / velocity / position
-        acceleration = force / mass
-        velocities[i] += acceleration * 0.0004  # delta time
-        positions[i] += velocities[i]
-
-        # Handle collision
-        restitution = 0.4
-        if positions[i].x <= 0.0 or 1.0 <= positions[i].x:
-            velocities[i].x *= -restitution
-            positions[i].x = ti.math.clamp(positions[i].x, 0.01, 0.99)
-        elif positions[i].y <= 0.0:
-            velocities[i].y *= -restitution
-            positions[i].y = ti.math.max(positions[i].y, 0.01)
-
-        # Compute color
-        colors[i] = (0.7 - pressures[i], 0.7 - pressures[i], 1.0)
+@ti.data_oriented
+class ParticleFluid:
+    # A step runs as separate kernels: density, pressure, force, integrate, collide.
+    # Positions and velocities are ping-pong buffers, so no kernel writes state that another
+    # particle still reads, and particle data is stored as SoA so integration is a plain stream.
+    # Together with the sorted grid cells below, every step is bit-for-bit reproducible.
+    # update() advances one frame of frame_time in as many substeps as the CFL, force and viscosity
+    # limits ask for; a larger cfl trades accuracy for fewer substeps.
+    #
+    # The fields hold batch_size independent simulations one after another: particle i of simulation b
+    # is at index b * num_particles + i (see particle_range). Each simulation has its own row of the
+    # parameter table (radius, stiffness, restitution) and its own active particle count, and all of
+    # them are advanced by the same kernel launches. radius, stiffness and restitution take either one
+    # value for all simulations or one value per simulation.
+    stages = ["grid", "density", "pressure", "force", "time step", "integrate", "collide"]
+
+    def __init__(self, num_particles, radius=0.03, use_grid=True, frame_time=0.02, cfl=0.4, viscosity=0.0,
+                 max_substeps=256, batch_size=1, stiffness=0.00007, restitution=0.4):
+        self.num_particles = num_particles
+        self.batch_size = batch_size
+        self.use_grid = use_grid
+        self.frame_time = frame_time
+        self.cfl = cfl
+        self.viscosity = viscosity
+        self.max_substeps = max_substeps
+        size = batch_size * num_particles
+        self.position_buffers = [ti.Vector.field(2, dtype=float, shape=size, layout=ti.Layout.SOA) for _ in range(2)]
+        self.velocity_buffers = [ti.Vector.field(2, dtype=float, shape=size, layout=ti.Layout.SOA) for _ in range(2)]
+        self.current = 0
+        self.densities = ti.field(dtype=float, shape=size)
+        self.pressures = ti.field(dtype=float, shape=size)
+        self.forces = ti.Vector.field(2, dtype=float, shape=size, layout=ti.Layout.SOA)
+        self.colors = ti.Vector.field(3, dtype=float, shape=size)
+
+        # parameter table, one row per simulation
+        def table(value):
+            return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=np.float32), batch_size))
+        self.radii = ti.field(dtype=float, shape=batch_size)
+        self.radii.from_numpy(table(radius))
+        self.stiffnesses = ti.field(dtype=float, shape=batch_size)
+        self.stiffnesses.from_numpy(table(stiffness))
+        self.restitutions = ti.field(dtype=float, shape=batch_size)
+        self.restitutions.from_numpy(table(restitution))
+        self.num_active = ti.field(dtype=int, shape=batch_size)
+
+        # time stepping state stays on the device; the host reads max_time_left once per batch of substeps
+        self.max_speed = ti.field(dtype=float, shape=batch_size)
+        self.max_acceleration = ti.field(dtype=float, shape=batch_size)
+        self.dt = ti.field(dtype=float, shape=batch_size)
+        self.time_left = ti.field(dtype=float, shape=batch_size)
+        self.max_time_left = ti.field(dtype=float, shape=())
+        self.substep_counts = ti.field(dtype=int, shape=batch_size)
+        self.substeps = 0
+
+        # Uniform grid over [0, 1]^2 with cells no smaller than the kernel support 2 * radius,
+        # so all neighbors of a particle are in the 3x3 cells around it. Particles are
+        # counting-sorted by cell every step; positions outside the box are clamped to the border cells.
+        # Simulation b owns the cells from b * num_cells on, of which it uses grid_sizes[b]^2.
+        grid_sizes = np.maximum((1.0 / (2.0 * table(radius))).astype(np.int32), 1)
+        self.grid_sizes = ti.field(dtype=int, shape=batch_size)
+        self.grid_sizes.from_numpy(grid_sizes)
+        self.num_cells = int(grid_sizes.max()) ** 2
+        self.cell_counts = ti.field(dtype=int, shape=batch_size * self.num_cells)
+        self.cell_starts = ti.field(dtype=int, shape=batch_size * self.num_cells)
+        self.particle_cells = ti.field(dtype=int, shape=size)
+        self.cell_cursors = ti.field(dtype=int, shape=batch_size * self.num_cells)
+        self.sorted_particles = ti.field(dtype=int, shape=size)
+
+        # seconds spent in each stage, filled in when profile is set
+        self.profile = False
+        self.stage_times = {stage: 0.0 for stage in self.stages}
+
+    @property
+    def positions(self):
+        return self.position_buffers[self.current]
+
+    @property
+    def velocities(self):
+        return self.velocity_buffers[self.current]
+
+    def particle_range(self, b):
+        # slice of simulation b in the fields, e.g. fluid.positions.to_numpy()[fluid.particle_range(b)]
+        return slice(b * self.num_particles, (b + 1) * self.num_particles)
+
+    @ti.kernel
+    def _initialize(self, positions: ti.template(), velocities: ti.template()):
+        for i in ti.grouped(positions):
+            positions[i].x = ti.random(float) * 0.1 + 0.1
+            positions[i].y = ti.random(float) * 0.1 + 0.8
+            velocities[i] = [1.0, -0.5]
+
+    def initialize(self):
+        # particles that are not active yet are never written, so both buffers start out equal
+        self._initialize(self.position_buffers[0], self.velocity_buffers[0])
+        self.position_buffers[1].copy_from(self.position_buffers[0])
+        self.velocity_buffers[1].copy_from(self.velocity_buffers[0])
+        self.current = 0
+
+    @ti.func
+    def simulation(self, p):
+        # index of the simulation that particle p belongs to
+        b = 0
+        if ti.static(self.batch_size > 1):
+            b = p // self.num_particles
+        return b
+
+    @ti.func
+    def is_active(self, p):
+        b = self.simulation(p)
+        return p - b * self.num_particles < self.num_active[b]
+
+    @ti.func
+    def is_running(self, p):
+        # active particle of a simulation that has not finished the frame yet
+        return self.is_active(p) and self.time_left[self.simulation(p)] > 0.0
+
+    @ti.func
+    def cell_coord(self, b, position):
+        grid_size = self.grid_sizes[b]
+        return ti.math.clamp(ti.cast(ti.floor(position * grid_size), int), 0, grid_size - 1)
+
+    @ti.kernel
+    def build_grid(self, positions: ti.template()):
+        for c in self.cell_counts:
+            self.cell_counts[c] = 0
+        for p in positions:
+            if self.is_running(p):
+                b = self.simulation(p)
+                cell = self.cell_coord(b, positions[p])
+                c = b * self.num_cells + cell.x * self.grid_sizes[b] + cell.y
+                self.particle_cells[p] = c
+                ti.atomic_add(self.cell_counts[c], 1)
+        # prefix sum and scatter, one simulation per thread: a counting sort that visits the particles
+        # in index order, so every cell lists its particles by index and the neighbor order, and with it
+        # the floating-point sums, is the same in every run. It is O(particles + cells) however the
+        # particles are spread, also when all of them are clamped into one border cell.
+        for b in range(self.batch_size):
+            start = b * self.num_particles
+            for c in range(b * self.num_cells, b * self.num_cells + self.grid_sizes[b] * self.grid_sizes[b]):
+                self.cell_starts[c] = start
+                self.cell_cursors[c] = start
+                start += self.cell_counts[c]
+            for p in range(b * self.num_particles, b * self.num_particles + self.num_active[b]):
+                if self.is_running(p):
+                    c = self.particle_cells[p]
+                    self.sorted_particles[self.cell_cursors[c]] = p
+                    self.cell_cursors[c] += 1
+
+    @ti.func
+    def particle_order(self, n):
+        # with the grid, visit particles cell by cell: neighboring threads then gather
+        # the same neighbors, which keeps them in cache
+        i = n
+        if ti.static(self.use_grid):
+            i = self.sorted_particles[n]
+        return i
+
+    @ti.func
+    def density_term(self, positions: ti.template(), i, j, radius):
+        mass = 1.0
+        return mass * spline_kernel(positions[i] - positions[j], radius)
+
+    @ti.func
+    def force_term(self, positions: ti.template(), velocities: ti.template(), i, j, radius):
+        mass = 1.0
+        pi = self.pressures[i]
+        pj = self.pressures[j]
+        r = positions[i] - positions[j]
+        grad = spline_kernel_gradient(r, radius)
+        force = -mass / self.densities[j] * (pi + pj) / 2.0 * grad
+        if ti.static(self.viscosity > 0.0):
+            # laminar viscosity (Morris et al. 1997)
+            laplacian = -2.0 * r.dot(grad) / (r.dot(r) + 0.01 * radius ** 2)
+            force += self.viscosity * mass / self.densities[j] * (velocities[j] - velocities[i]) * laplacian
+        return force
+
+    @ti.kernel
+    def compute_density(self, positions: ti.template()):
+        for n in positions:
+            if self.is_running(n):
+                i = self.particle_order(n)
+                b = self.simulation(i)
+                radius = self.radii[b]
+                density = 0.0
+                if ti.static(self.use_grid):
+                    grid_size = self.grid_sizes[b]
+                    cell = self.cell_coord(b, positions[i])
+                    for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
+                        neighbor = cell + offset
+                        if 0 <= neighbor.x < grid_size and 0 <= neighbor.y < grid_size:
+                            c = b * self.num_cells + neighbor.x * grid_size + neighbor.y
+                            for k in range(self.cell_starts[c], self.cell_starts[c] + self.cell_counts[c]):
+                                density += self.density_term(positions, i, self.sorted_particles[k], radius)
+                else:
+                    first = b * self.num_particles
+                    for j in range(first, first + self.num_active[b]):
+                        density += self.density_term(positions, i, j, radius)
+                self.densities[i] = density
+
+    @ti.kernel
+    def compute_pressure(self):
+        for i in self.pressures:
+            if self.is_running(i):
+                self.pressures[i] = max(self.stiffnesses[self.simulation(i)] * self.densities[i], 0.0)
+
+    @ti.kernel
+    def compute_force(self, positions: ti.template(), velocities: ti.template()):
+        for n in positions:
+            if self.is_running(n):
+                i = self.particle_order(n)
+                b = self.simulation(i)
+                radius = self.radii[b]
+                force = ti.math.vec2(0.0)
+                force.y -= 0.98  # gravity
+                if ti.static(self.use_grid):
+                    grid_size = self.grid_sizes[b]
+                    cell = self.cell_coord(b, positions[i])
+                    for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
+                        neighbor = cell + offset
+                        if 0 <= neighbor.x < grid_size and 0 <= neighbor.y < grid_size:
+                            c = b * self.num_cells + neighbor.x * grid_size + neighbor.y
+                            for k in range(self.cell_starts[c], self.cell_starts[c] + self.cell_counts[c]):
+                                force += self.force_term(positions, velocities, i, self.sorted_particles[k], radius)
+                else:
+                    first = b * self.num_particles
+                    for j in range(first, first + self.num_active[b]):
+                        force += self.force_term(positions, velocities, i, j, radius)
+                self.forces[i] = force
+
+    @ti.kernel
+    def compute_time_step(self, velocities: ti.template()):
+        mass = 1.0
+        for b in self.max_speed:
+            self.max_speed[b] = 0.0
+            self.max_acceleration[b] = 0.0
+        # reduce blocks of particles locally, then one atomic per block and simulation
+        block_size = 1024
+        for b, block in ti.ndrange(self.batch_size, (self.num_particles + block_size - 1) // block_size):
+            if self.time_left[b] > 0.0:
+                speed = 0.0
+                acceleration = 0.0
+                first = b * self.num_particles
+                for i in range(first + block * block_size, first + ti.min((block + 1) * block_size, self.num_active[b])):
+                    speed = ti.max(speed, velocities[i].norm())
+                    acceleration = ti.max(acceleration, self.forces[i].norm() / mass)
+                ti.atomic_max(self.max_speed[b], speed)
+                ti.atomic_max(self.max_acceleration[b], acceleration)
+        self.max_time_left[None] = 0.0
+        for b in self.dt:
+            radius = self.radii[b]
+            dt = self.frame_time
+            if self.max_speed[b] > 0.0:
+                dt = ti.min(dt, self.cfl * radius / self.max_speed[b])
+            if self.max_acceleration[b] > 0.0:
+                dt = ti.min(dt, 0.25 * ti.sqrt(radius / self.max_acceleration[b]))
+            if ti.static(self.viscosity > 0.0):
+                dt = ti.min(dt, 0.125 * radius ** 2 / self.viscosity)
+            # never more than max_substeps per frame, and no sliver of a substep at the end
+            dt = ti.max(dt, self.frame_time / self.max_substeps)
+            time_left = self.time_left[b]
+            if dt >= time_left:
+                dt = time_left
+            elif dt > 0.5 * time_left:
+                dt = 0.5 * time_left
+            # a simulation that is done keeps dt = 0 until the others have caught up
+            if dt > 0.0:
+                self.substep_counts[b] += 1
+            self.dt[b] = dt
+            self.time_left[b] = time_left - dt
+            ti.atomic_max(self.max_time_left[None], time_left - dt)
+
+    @ti.kernel
+    def integrate(self, positions: ti.template(), velocities: ti.template(),
+                  new_positions: ti.template(), new_velocities: ti.template()):
+        mass = 1.0
+        for i in positions:
+            # also with dt = 0, so that the other buffer holds the state of finished simulations
+            if self.is_active(i):
+                dt = self.dt[self.simulation(i)]
+                acceleration = self.forces[i] / mass
+                new_velocities[i] = velocities[i] + acceleration * dt
+                new_positions[i] = positions[i] + new_velocities[i] * dt
+
+    @ti.kernel
+    def collide(self, positions: ti.template(), velocities: ti.template()):
+        for i in positions:
+            if self.is_active(i):
+                restitution = self.restitutions[self.simulation(i)]
+                if positions[i].x <= 0.0 or 1.0 <= positions[i].x:
+                    velocities[i].x *= -restitution
+                    positions[i].x = ti.math.clamp(positions[i].x, 0.01, 0.99)
+                elif positions[i].y <= 0.0:
+                    velocities[i].y *= -restitution
+                    positions[i].y = ti.math.max(positions[i].y, 0.01)
+
+                # Compute color
+                self.colors[i] = (0.7 - self.pressures[i], 0.7 - self.pressures[i], 1.0)
+
+    def substep(self):
+        positions, velocities = self.positions, self.velocities
+        new_positions, new_velocities = self.position_buffers[1 - self.current], self.velocity_buffers[1 - self.current]
+        stages = [
+            ("grid", lambda: self.build_grid(positions) if self.use_grid else None),
+            ("density", lambda: self.compute_density(positions)),
+            ("pressure", lambda: self.compute_pressure()),
+            ("force", lambda: self.compute_force(positions, velocities)),
+            ("time step", lambda: self.compute_time_step(velocities)),
+            ("integrate", lambda: self.integrate(positions, velocities, new_positions, new_velocities)),
+            ("collide", lambda: self.collide(new_positions, new_velocities)),
+        ]
+        for stage, run in stages:
+            if self.profile:
+                ti.sync()
+                start = time.perf_counter()
+                run()
+                ti.sync()
+                self.stage_times[stage] += time.perf_counter() - start
+            else:
+                run()
+        self.current = 1 - self.current
+
+    def begin_frame(self, num_active_particles):
+        # a count for all simulations or one per simulation
+        counts = np.broadcast_to(np.asarray(num_active_particles, dtype=np.int32), self.batch_size)
+        self.num_active.from_numpy(np.ascontiguousarray(counts))
+        self.time_left.fill(self.frame_time)
+        self.substep_counts.fill(0)
+
+    def update(self, num_active_particles):
+        # One frame. Every substep reads its dt from the device. The host launches the substeps in
+        # batches, as many as the last frame took, and reads back the remaining time only after each
+        # batch; substeps past the end of a simulation have dt = 0 and leave its state as it is.
+        # substeps is the count of the slowest simulation, substep_counts has all of them.
+        self.begin_frame(num_active_particles)
+        batch, launched = max(self.substeps, 1), 0
+        while True:
+            for _ in range(batch):
+                self.substep()
+            launched += batch
+            time_left = self.max_time_left[None]
+            if time_left <= 0.0:
+                break
+            # as many more as the part of the frame still left took so far
+            batch = max(math.ceil(launched * time_left / (self.frame_time - time_left)), 1)
+        self.substeps = int(self.substep_counts.to_numpy().max())
 
 
 if __name__ == '__main__':
-    ti.init(arch=ti.vulkan)
-    window = ti.ui.Window("Particle-based fluid", (1024, 1024), vsync=True)
-    canvas = window.get_canvas()
-    canvas.set_background_color((1, 1, 1))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--particles", type=int, default=1000)
+    parser.add_argument("--brute-force", action="store_true", help="visit all particles instead of the 3x3 grid cells")
+    parser.add_argument("--cfl", type=float, default=0.4, help="Courant number, larger is faster but less accurate")
+    parser.add_argument("--viscosity", type=float, default=0.0)
+    parser.add_argument("--frames", type=int, default=0, help="run this many frames without a window")
+    parser.add_argument("--record", help="record positions and velocities into this directory, see frame_store.py")
+    parser.add_argument("--benchmark", action="store_true", help="print step time vs particle count")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        from bench_util import measure
+        ti.init(arch=ti.cpu)
+        print(f"{'particles':>9} {'radius':>8} {'brute force [ms]':>17} {'grid [ms]':>10}")
+        stage_rows = []
+        for num_particles in [1000, 4000, 16000, 64000, 256000, 1000000]:
+            # a block of fluid with about the same number of neighbors per particle at every size
+            spacing = math.sqrt(0.9 * 0.45 / num_particles)
+            radius = spacing
+            rng = np.random.default_rng(0)
+            positions = np.stack([0.05 + rng.random(num_particles) * 0.9, 0.05 + rng.random(num_particles) * 0.45],
+                                 axis=1).astype(np.float32)
+            times = []
+            for use_grid in [False, True]:
+                if not use_grid and num_particles > 16000:
+                    times.append(None)
+                    continue
+                fluid = ParticleFluid(num_particles, radius, use_grid)
+
+                def reset():
+                    # every step starts from the same state; the pressure is not tuned for these radii
+                    # and the block would blow apart within a few steps
+                    fluid.positions.from_numpy(positions)
+                    fluid.velocities.fill(0.0)
+                    fluid.begin_frame(num_particles)
+
+                for _ in range(2):  # compile the kernels for both buffer orders
+                    reset()
+                    fluid.substep()
+                times.append(measure(lambda: (reset(), fluid.substep())) - measure(reset))
+            print(f"{num_particles:>9} {radius:>8.5f} " +
+                  " ".join(f"{t * 1e3:>{w}.2f}" if t is not None else f"{'-':>{w}}" for t, w in zip(times, [17, 10])))
+            # per-stage breakdown of the grid path
+            fluid.profile = True
+            for _ in range(3):
+                reset()
+                fluid.substep()
+            stage_rows.append((num_particles, [fluid.stage_times[stage] / 3 for stage in fluid.stages]))
+        print(f"\n{'particles':>9}" + "".join(f" {stage + ' [ms]':>15}" for stage in ParticleFluid.stages))
+        for num_particles, stage_times in stage_rows:
+            print(f"{num_particles:>9}" + "".join(f" {t * 1e3:>15.2f}" for t in stage_times))
+
+        # the demo scene for 300 frames: one fixed step per frame vs CFL-driven substeps
+        num_frames = 300
+        print(f"\n{'particles':>9} {'time step':>10} {'substeps/frame':>15} {'max':>5} {'ms/frame':>9} {'max speed':>10}")
+        for num_particles in [1000, 4000, 16000]:
+            radius = 0.03 * math.sqrt(1000 / num_particles)
+            for name, options in [("fixed", dict(max_substeps=1)), ("cfl 0.4", dict(cfl=0.4)), ("cfl 1.0", dict(cfl=1.0))]:
+                fluid = ParticleFluid(num_particles, radius, **options)
+                for _ in range(2):  # compile
+                    fluid.update(1)
+                fluid.initialize()
+                num_active_particles = 0
+                substeps = []
+                start = time.perf_counter()
+                for frame in range(num_frames):
+                    num_active_particles = min(num_active_particles + max(num_particles // 200, 1), num_particles)
+                    fluid.update(num_active_particles)
+                    substeps.append(fluid.substeps)
+                max_speed = np.linalg.norm(fluid.velocities.to_numpy(), axis=1).max()
+                elapsed = time.perf_counter() - start
+                print(f"{num_particles:>9} {name:>10} {np.mean(substeps):>15.2f} {max(substeps):>5} "
+                      f"{elapsed / num_frames * 1e3:>9.2f} {max_speed:>10.3g}")
+
+        # ensembles: a sweep over radius, stiffness and restitution in one launch per stage.
+        # "compile" is what every extra process would pay again for the same sweep
+        print(f"\n{'particles':>9} {'batch':>6} {'compile [s]':>12} {'substep [ms]':>13} {'Mparticle-steps/s':>18}")
+        for num_particles in [1000, 4000]:
+            spacing = math.sqrt(0.9 * 0.45 / num_particles)
+            rng = np.random.default_rng(0)
+            positions = np.stack([0.05 + rng.random(num_particles) * 0.9, 0.05 + rng.random(num_particles) * 0.45],
+                                 axis=1).astype(np.float32)
+            for batch_size in [1, 2, 4, 8, 16, 32, 64]:
+                sweep = np.linspace(0.0, 1.0, batch_size)
+                fluid = ParticleFluid(num_particles, spacing * (1.0 + 0.5 * sweep), batch_size=batch_size,
+                                      stiffness=0.00007 * (1.0 + sweep), restitution=0.2 + 0.6 * sweep)
+
+                def reset():
+                    fluid.positions.from_numpy(np.tile(positions, (batch_size, 1)))
+                    fluid.velocities.fill(0.0)
+                    fluid.begin_frame(num_particles)
+
+                start = time.perf_counter()
+                for _ in range(2):  # compile the kernels for both buffer orders
+                    reset()
+                    fluid.substep()
+                ti.sync()
+                compile_time = time.perf_counter() - start
+                substep_time = measure(lambda: (reset(), fluid.substep())) - measure(reset)
+                print(f"{num_particles:>9} {batch_size:>6} {compile_time:>12.2f} {substep_time * 1e3:>13.2f} "
+                      f"{batch_size * num_particles / substep_time / 1e6:>18.2f}")
+        exit()
+
+    ti.init(arch=ti.cpu if args.frames else ti.vulkan)
+    if not args.frames:
+        window = ti.ui.Window("Particle-based fluid", (1024, 1024), vsync=True)
+        canvas = window.get_canvas()
+        canvas.set_background_color((1, 1, 1))
+        gui = window.get_gui()
 
-    radius = 0.03
-    num_particles = 1000
+    # keep the emitter block about as crowded as the 1000-particle default
+    radius = 0.03 * math.sqrt(1000 / args.particles)
+    fluid = ParticleFluid(args.particles, radius, use_grid=not args.brute_force, cfl=args.cfl, viscosity=args.viscosity)
     num_active_particles = 0
-    positions = ti.Vector.field(2, dtype=float, shape=num_particles)
-    densities = ti.field(dtype=float, shape=num_particles)
-    pressures = ti.field(dtype=float, shape=num_particles)
-    velocities = ti.Vector.field(2, dtype=float, shape=num_particles)
-    colors = ti.Vector.field(3, dtype=float, shape=num_particles)
-    initialize()
-    while window.running:
-        num_active_particles = min(num_active_particles + 5, num_particles)
-        update(num_active_particles)
-        canvas.circles(positions, radius / 2.0, per_vertex_color=colors)
-        window.show()
+    fluid.initialize()
+    writer = FrameWriter(args.record) if args.record else None
+    frame = 0
+    while frame < args.frames if args.frames else window.running:
+        num_active_particles = min(num_active_particles + max(args.particles // 200, 1), args.particles)
+        start = time.perf_counter()
+        fluid.update(num_active_particles)
+        if writer:
+            writer.write(positions=fluid.positions, velocities=fluid.velocities)
+        if not args.frames:
+            canvas.circles(fluid.positions, radius / 2.0, per_vertex_color=fluid.colors)
+            gui.text(f"{fluid.substeps} substeps, {(time.perf_counter() - start) * 1e3:.1f} ms")
+            window.show()
+        frame += 1
+    if writer:
+        writer.close()
@@ -1,30 +1,145 @@
+import argparse
+import time
+import numpy as np
 import taichi as ti
 import math
-from raytracing import intersect_spheres, reflect, eps
+from raytracing import intersect_spheres, occluded, reflect, eps
+from sampler import Sampler, SAMPLERS
+from sky_cache import SkyCache
+
+
+def build_sky_distribution(image):
+    # 2D piecewise-constant distribution proportional to luminance * sin(theta):
+    # a marginal CDF over rows and a conditional CDF over the texels of each row
+    width, height = image.shape[0], image.shape[1]
+    luminance = image.astype(np.float64) @ np.array([0.2126, 0.7152, 0.0722])
+    theta = (height - 1 - np.arange(height) + 0.5) / height * math.pi
+    weights = luminance * np.sin(theta)[None, :]
+    row_sums = weights.sum(axis=0)
+    conditional_cdf = np.zeros((width + 1, height))
+    conditional_cdf[1:] = np.cumsum(weights, axis=0) / np.where(row_sums > 0.0, row_sums, 1.0)
+    conditional_cdf[:, row_sums == 0.0] = np.linspace(0.0, 1.0, width + 1)[:, None]
+    marginal_cdf = np.concatenate([[0.0], np.cumsum(row_sums)]) / row_sums.sum()
+    return marginal_cdf, conditional_cdf, weights / row_sums.sum()
 
 
 @ti.func
-def sample_sky_image(direction):
-    theta = ti.math.acos(direction.y)
+def sky_texel(direction):
+    theta = ti.math.acos(ti.math.clamp(direction.y, -1.0, 1.0))
     phi = ti.math.atan2(direction.z, direction.x)
     if phi < 0:
         phi += 2.0 * math.pi
 
     width, height = sky_image.shape[0], sky_image.shape[1]
-    i = int(phi / (2.0 * math.pi) * width)
-    j = height - int(theta / math.pi * height)
+    i = ti.min(int(phi / (2.0 * math.pi) * width), width - 1)
+    j = ti.math.clamp(height - 1 - int(theta / math.pi * height), 0, height - 1)
+    return i, j, theta
+
+
+@ti.func
+def sample_sky_image(direction):
+    i, j, _ = sky_texel(direction)
     return sky_image[i, j] / 255.0
 
 
 @ti.func
-def sample_direction(normal):
+def sky_radiance(direction):
+    return sample_sky_image(direction) * 2.0
+
+
+@ti.func
+def sky_pdf(direction):
+    i, j, theta = sky_texel(direction)
+    width, height = sky_image.shape[0], sky_image.shape[1]
+    pdf = 0.0
+    if ti.sin(theta) > 0.0:
+        pdf = sky_texel_probs[i, j] * width * height / (2.0 * math.pi * math.pi * ti.sin(theta))
+    return pdf
+
+
+@ti.func
+def sample_sky_direction(u1, u2):
+    width, height = sky_image.shape[0], sky_image.shape[1]
+    lo, hi = 0, height
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if sky_marginal_cdf[mid] <= u1:
+            lo = mid
+        else:
+            hi = mid
+    j = lo
+    v = (u1 - sky_marginal_cdf[j]) / ti.max(sky_marginal_cdf[j + 1] - sky_marginal_cdf[j], 1e-12)
+
+    lo, hi = 0, width
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if sky_conditional_cdf[mid, j] <= u2:
+            lo = mid
+        else:
+            hi = mid
+    i = lo
+    u = (u2 - sky_conditional_cdf[i, j]) / ti.max(sky_conditional_cdf[i + 1, j] - sky_conditional_cdf[i, j], 1e-12)
+
+    phi = (i + ti.math.clamp(u, 0.0, 1.0)) / width * 2.0 * math.pi
+    theta = (height - j - ti.math.clamp(v, 0.0, 1.0)) / height * math.pi
+    direction = ti.Vector([ti.sin(theta) * ti.cos(phi), ti.cos(theta), ti.sin(theta) * ti.sin(phi)])
+    return direction, sky_pdf(direction)
+
+
+@ti.func
+def power_heuristic(pdf, other_pdf):
+    return pdf * pdf / (pdf * pdf + other_pdf * other_pdf)
+
+
+@ti.func
+def sample_sky_light(pixel, frame, dimension, hit_position, hit_normal, hit_color):
+    # next-event estimation toward the sky, MIS-weighted against BSDF sampling
+    color = ti.Vector([0.0, 0.0, 0.0])
+    light_direction, light_pdf = sample_sky_direction(random(pixel, frame, dimension),
+                                                      random(pixel, frame, dimension + 1))
+    cos_light = ti.math.dot(light_direction, hit_normal)
+    if light_pdf > 0.0 and cos_light > 0.0:
+        if not occluded_scene(hit_position + 0.001 * light_direction, light_direction, 10000.0):
+            brdf = hit_color / math.pi
+            mis_weight = power_heuristic(light_pdf, cos_light / math.pi)
+            color = brdf * cos_light * sky_radiance(light_direction) / light_pdf * mis_weight
+    return color
+
+
+@ti.func
+def sky_mis_weight(direction, bsdf_pdf):
+    # bsdf_pdf is 0 for camera rays and specular bounces, which NEE cannot sample
+    mis_weight = 1.0
+    if env_sampling[None] and bsdf_pdf > 0.0:
+        mis_weight = power_heuristic(bsdf_pdf, sky_pdf(direction))
+    return mis_weight
+
+
+@ti.func
+def clamp_sample(color):
+    # the per-sample clamp to [0, 1] of the default image; env sampling turns it off, because the
+    # clamped means of the two sky estimators differ
+    if clamp_samples[None]:
+        color = ti.math.clamp(color, 0.0, 1.0)
+    return color
+
+
+@ti.func
+def random(pixel, frame, dimension):
+    # Counter-based sample: the same (pixel, frame, dimension) always
+    # gives the same value, so both render modes draw identical samples
+    return sampler.sample(pixel, frame, dimension)
+
+
+@ti.func
+def sample_direction(normal, u1, u2):
     w = normal
     u = ti.math.normalize(ti.math.cross(ti.Vector([0.0, 1.0, 0.0]), w))
     if ti.abs(w.x) < eps:
         u = ti.math.normalize(ti.math.cross(ti.Vector([1.0, 0.0, 0.0]), w))
     v = ti.math.cross(w, u)
-    r1 = 2.0 * math.pi * ti.random()
-    r2 = ti.random()
+    r1 = 2.0 * math.pi * u1
+    r2 = u2
     dir = ti.math.normalize(u * ti.cos(r1) * ti.sqrt(r2) +
                             v * ti.sin(r1) * ti.sqrt(r2) +
                             w * ti.sqrt(1.0 - r2))
@@ -32,51 +147,323 @@ def sample_direction(normal):
     return dir, pdf
 
 
+@ti.func
+def intersect_scene(origin, direction):
+    hit_distance, hit_position, hit_normal, hit_sphere = intersect_spheres(origin, direction, sphere_centers, sphere_radiuses, accel)
+    hit_material = MISS
+    hit_emission = ti.Vector([0.0, 0.0, 0.0])
+    hit_color = ti.Vector([0.0, 0.0, 0.0])
+    if hit_sphere != -1:
+        hit_material = sphere_materials[hit_sphere]
+        hit_emission = sphere_emissions[hit_sphere]
+        hit_color = sphere_colors[hit_sphere]
+    if ti.static(bool(mesh)):
+        distance, position, normal, _ = mesh.intersect(origin, direction)
+        if distance < hit_distance:
+            hit_position = position
+            hit_normal = normal
+            hit_material = mesh_material
+            hit_emission = ti.Vector([0.0, 0.0, 0.0])
+            hit_color = ti.Vector(mesh_color)
+    return hit_position, hit_normal, hit_material, hit_emission, hit_color
+
+
+@ti.func
+def occluded_scene(origin, direction, max_distance):
+    hit = occluded(origin, direction, max_distance, sphere_centers, sphere_radiuses, accel)
+    if ti.static(bool(mesh)):
+        if not hit:
+            hit = mesh.occluded(origin, direction, max_distance)
+    return hit
+
+
+@ti.func
+def first_hit_aovs(origin, hit_position, hit_normal, hit_material, hit_color):
+    albedo = ti.Vector([1.0, 1.0, 1.0])
+    normal = ti.Vector([0.0, 0.0, 0.0])
+    depth = 10000.0
+    if hit_material != MISS:
+        normal = hit_normal
+        depth = ti.math.distance(origin, hit_position)
+        if hit_material != LIGHT:
+            albedo = hit_color
+    return albedo, normal, depth
+
+
+@ti.func
+def trace_path(i, j, frame):
+    screen_position = ti.Vector([i / width - 0.5, j / height - 0.5, 0])
+    origin = ti.Vector([0.0, 0.0, 1.0])
+    direction = ti.math.normalize(screen_position - origin)
+    weight = ti.Vector([1.0, 1.0, 1.0])
+    color = ti.Vector([0.0, 0.0, 0.0])
+    pixel = i * height + j
+    bsdf_pdf = 0.0
+    first_albedo, first_normal, first_depth = ti.Vector([1.0, 1.0, 1.0]), ti.Vector([0.0, 0.0, 0.0]), 10000.0
+    for depth in range(max_depth):
+        hit_position, hit_normal, hit_material, hit_emission, hit_color = intersect_scene(origin, direction)
+        if depth == 0:
+            first_albedo, first_normal, first_depth = first_hit_aovs(origin, hit_position, hit_normal, hit_material, hit_color)
+
+        if hit_material == MISS:
+            color += weight * sky_radiance(direction) * sky_mis_weight(direction, bsdf_pdf)
+            break
+
+        if hit_material == LIGHT:
+            color += weight * hit_emission
+        elif hit_material == DIFFUSE:
+            if env_sampling[None]:
+                color += weight * sample_sky_light(pixel, frame, 4 * depth + 2, hit_position, hit_normal, hit_color)
+            direction, pdf = sample_direction(hit_normal, random(pixel, frame, 4 * depth),
+                                              random(pixel, frame, 4 * depth + 1))
+            origin = hit_position + 0.001 * direction
+            brdf = hit_color / math.pi
+            weight *= brdf * ti.math.dot(direction, hit_normal) / pdf
+            bsdf_pdf = pdf
+        elif hit_material == MIRROR:
+            direction = reflect(direction, hit_normal)
+            origin = hit_position + 0.001 * direction
+            weight *= hit_color
+            bsdf_pdf = 0.0
+    return color, first_albedo, first_normal, first_depth
+
+
+@ti.func
+def write_aovs(i, j, albedo, normal, depth):
+    albedos[i, j] = albedo
+    normals[i, j] = normal
+    depths[i, j] = depth
+
+
 @ti.kernel
 def render(frame: int):
+    for i, j in ti.ndrange((region[None][0], region[None][2]), (region[None][1], region[None][3])):
+        color, albedo, normal, depth = trace_path(i, j, frame)
+        write_aovs(i, j, albedo, normal, depth)
+        colors[i, j] = (clamp_sample(color) + colors[i, j] * frame) / (frame + 1)
+
+
+# Adaptive sampling: a per-pixel sample count and Welford mean/variance of the
+# luminance. Converged pixels drop out of the active list and get no more samples.
+@ti.func
+def luminance(color):
+    return ti.math.dot(color, ti.Vector([0.2126, 0.7152, 0.0722]))
+
+
+@ti.func
+def is_converged(i, j, threshold):
+    n = sample_counts[i, j]
+    converged = False
+    if n >= min_samples:
+        standard_error = ti.sqrt(luminance_m2[i, j] / (n - 1) / n)
+        converged = standard_error <= threshold * (luminance_means[i, j] + 0.01)
+    return converged
+
+
+@ti.kernel
+def collect_active_pixels(threshold: float, max_samples: int) -> int:
+    num_active_pixels[None] = 0
+    for i, j in colors:
+        if sample_counts[i, j] < max_samples and not is_converged(i, j, threshold):
+            active_pixels[ti.atomic_add(num_active_pixels[None], 1)] = i * height + j
+    return num_active_pixels[None]
+
+
+@ti.kernel
+def render_adaptive(num_active: int):
+    for k in range(num_active):
+        i, j = active_pixels[k] // height, active_pixels[k] % height
+        n = sample_counts[i, j]
+        color, albedo, normal, depth = trace_path(i, j, n)  # the n-th sample of a pixel is the same as in frame n
+        write_aovs(i, j, albedo, normal, depth)
+        color = clamp_sample(color)
+        value = luminance(color)
+        delta = value - luminance_means[i, j]
+        luminance_means[i, j] += delta / (n + 1)
+        luminance_m2[i, j] += delta * (value - luminance_means[i, j])
+        colors[i, j] = (color + colors[i, j] * n) / (n + 1)
+        sample_counts[i, j] = n + 1
+
+
+def render_adaptive_pass(threshold, max_samples):
+    num_active = collect_active_pixels(threshold, max_samples)
+    if num_active > 0:
+        render_adaptive(num_active)
+    return num_active
+
+
+# Wavefront mode: the megakernel above split into stages connected by ray queues.
+# Paths are compacted into the next queue after shading, so terminated paths stop
+# occupying lanes, and each material is shaded by its own coherent kernel.
+@ti.func
+def push_ray(queue, origin, direction, weight, pixel, bsdf_pdf):
+    slot = ti.atomic_add(queue_counts[queue], 1)
+    queue_origins[queue, slot] = origin
+    queue_directions[queue, slot] = direction
+    queue_weights[queue, slot] = weight
+    queue_pixels[queue, slot] = pixel
+    queue_pdfs[queue, slot] = bsdf_pdf
+
+
+@ti.kernel
+def generate_rays():
+    queue_counts[1] = 0
     for i, j in colors:
         screen_position = ti.Vector([i / width - 0.5, j / height - 0.5, 0])
         origin = ti.Vector([0.0, 0.0, 1.0])
-        direction = ti.math.normalize(screen_position - origin)
-        weight = ti.Vector([1.0, 1.0, 1.0])
-        color = ti.Vector([0.0, 0.0, 0.0])
-        for depth in range(8):
-            _, hit_position, hit_normal, hit_sphere = intersect_spheres(origin, direction, sphere_centers, sphere_radiuses)
-
-            if hit_sphere == -1:
-                sky_color = sample_sky_image(direction)
-                color += weight * sky_color * 2.0
-                break
+        pixel = i * height + j
+        queue_origins[0, pixel] = origin
+        queue_directions[0, pixel] = ti.math.normalize(screen_position - origin)
+        queue_weights[0, pixel] = ti.Vector([1.0, 1.0, 1.0])
+        queue_pixels[0, pixel] = pixel
+        queue_pdfs[0, pixel] = 0.0
+        path_radiances[pixel] = ti.Vector([0.0, 0.0, 0.0])
+    queue_counts[0] = width * height
 
-            hit_emission = sphere_emissions[hit_sphere]
-            hit_color = sphere_colors[hit_sphere]
-            hit_material = sphere_materials[hit_sphere]
-            if hit_material == LIGHT:
-                color += weight * hit_emission
-            elif hit_material == DIFFUSE:
-                direction, pdf = sample_direction(hit_normal)
-                origin = hit_position + 0.001 * direction
-                brdf = hit_color / math.pi
-                weight *= brdf * ti.math.dot(direction, hit_normal) / pdf
-            elif hit_material == MIRROR:
-                direction = reflect(direction, hit_normal)
-                origin = hit_position + 0.001 * direction
-                weight *= hit_color
 
-        color = ti.math.clamp(color, 0.0, 1.0)
-        colors[i, j] = (color + colors[i, j] * frame) / (frame + 1)
+@ti.kernel
+def intersect_queue(queue: int, num_rays: int, depth: int):
+    for m in material_counts:
+        material_counts[m] = 0
+    for k in range(num_rays):  # material queues are indexed by material - MISS, misses go to queue 0
+        origin = queue_origins[queue, k]
+        hit_position, hit_normal, hit_material, hit_emission, hit_color = intersect_scene(
+            origin, queue_directions[queue, k])
+        if depth == 0:
+            pixel = queue_pixels[queue, k]
+            albedo, normal, distance = first_hit_aovs(origin, hit_position, hit_normal, hit_material, hit_color)
+            write_aovs(pixel // height, pixel % height, albedo, normal, distance)
+        hit_positions[k] = hit_position
+        hit_normals[k] = hit_normal
+        hit_emissions[k] = hit_emission
+        hit_colors[k] = hit_color
+        slot = ti.atomic_add(material_counts[hit_material - MISS], 1)
+        material_queues[hit_material - MISS, slot] = k
+
+
+@ti.kernel
+def shade_miss(queue: int):
+    for n in range(material_counts[0]):
+        k = material_queues[0, n]
+        direction = queue_directions[queue, k]
+        mis_weight = sky_mis_weight(direction, queue_pdfs[queue, k])
+        path_radiances[queue_pixels[queue, k]] += queue_weights[queue, k] * sky_radiance(direction) * mis_weight
+
+
+@ti.kernel
+def shade_light(queue: int, depth: int):
+    for n in range(material_counts[LIGHT - MISS]):
+        k = material_queues[LIGHT - MISS, n]
+        pixel = queue_pixels[queue, k]
+        # the megakernel keeps hitting the light until max_depth; add those terms at once
+        for _ in range(depth, max_depth):
+            path_radiances[pixel] += queue_weights[queue, k] * hit_emissions[k]
+
+
+@ti.kernel
+def shade_diffuse(queue: int, depth: int, frame: int):
+    for n in range(material_counts[DIFFUSE - MISS]):
+        k = material_queues[DIFFUSE - MISS, n]
+        pixel = queue_pixels[queue, k]
+        hit_normal = hit_normals[k]
+        if env_sampling[None]:
+            path_radiances[pixel] += queue_weights[queue, k] * sample_sky_light(
+                pixel, frame, 4 * depth + 2, hit_positions[k], hit_normal, hit_colors[k])
+        direction, pdf = sample_direction(hit_normal, random(pixel, frame, 4 * depth),
+                                          random(pixel, frame, 4 * depth + 1))
+        brdf = hit_colors[k] / math.pi
+        weight = queue_weights[queue, k] * (brdf * ti.math.dot(direction, hit_normal) / pdf)
+        push_ray(1 - queue, hit_positions[k] + 0.001 * direction, direction, weight, pixel, pdf)
+
+
+@ti.kernel
+def shade_mirror(queue: int):
+    for n in range(material_counts[MIRROR - MISS]):
+        k = material_queues[MIRROR - MISS, n]
+        direction = reflect(queue_directions[queue, k], hit_normals[k])
+        weight = queue_weights[queue, k] * hit_colors[k]
+        push_ray(1 - queue, hit_positions[k] + 0.001 * direction, direction, weight, queue_pixels[queue, k], 0.0)
+
+
+@ti.kernel
+def resolve(frame: int):
+    for i, j in colors:
+        colors[i, j] = (clamp_sample(path_radiances[i * height + j]) + colors[i, j] * frame) / (frame + 1)
+
+
+def render_wavefront(frame):
+    generate_rays()
+    queue, num_rays = 0, width * height
+    for depth in range(max_depth):
+        intersect_queue(queue, num_rays, depth)
+        shade_miss(queue)
+        shade_light(queue, depth)
+        shade_diffuse(queue, depth, frame)
+        shade_mirror(queue)
+        queue_counts[queue] = 0
+        queue = 1 - queue
+        num_rays = queue_counts[queue]
+        if num_rays == 0:
+            break
+    resolve(frame)
 
 
 if __name__ == '__main__':
-    ti.init(arch=ti.vulkan)
-    width, height = 1024, 1024
-    LIGHT, DIFFUSE, MIRROR = 0, 1, 2
-    image_data = ti.tools.imread("data/modern_buildings_2_2k.hdr", 3)
+    from render_farm import add_farm_arguments, run_farm, serve_tiles, worker_threads, TileBuffer
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mesh", nargs="?", help="optional OBJ file, e.g. data/torus_quad.obj")
+    parser.add_argument("--wavefront", action="store_true", help="queue-based render mode")
+    parser.add_argument("--env-sampling", action="store_true",
+                        help="also sample the sky by its luminance (next-event estimation), unclamped samples")
+    parser.add_argument("--adaptive", action="store_true", help="sample only pixels that have not converged")
+    parser.add_argument("--error-threshold", type=float, default=0.02, help="relative standard error per pixel")
+    parser.add_argument("--max-samples", type=int, default=1024, help="samples per pixel at most")
+    parser.add_argument("--time-budget", type=float, default=float("inf"), help="seconds of adaptive rendering")
+    parser.add_argument("--denoise", action="store_true", help="show the a-trous filtered image")
+    parser.add_argument("--save-buffers", help="write colors and AOVs to this .npz file on exit")
+    parser.add_argument("--sampler", choices=SAMPLERS, default="random", help="white noise or R_d quasirandom samples")
+    parser.add_argument("--benchmark", choices=["wavefront", "env-sampling", "adaptive", "denoise", "sampler"],
+                        help="run a CPU benchmark instead")
+    parser.add_argument("--sky-cache", help="directory for the decoded sky, default: data/.sky_cache")
+    parser.add_argument("--samples", type=int, default=64, help="samples per pixel of a frame rendered with --workers")
+    add_farm_arguments(parser)
+    args = parser.parse_args()
+
+    width, height = (256, 256) if args.benchmark in ["env-sampling", "adaptive", "denoise", "sampler"] else (1024, 1024)
+    if args.workers and not args.farm_worker:
+        run_farm(args, width, height)
+        exit()
+
+    ti.init(arch=ti.cpu if args.benchmark or args.farm_worker else ti.vulkan, cpu_max_num_threads=worker_threads(args))
+    max_depth = 8
+    MISS, LIGHT, DIFFUSE, MIRROR = -1, 0, 1, 2
+    # decoded once, memory-mapped from data/.sky_cache on later runs
+    sky_cache = SkyCache("data/modern_buildings_2_2k.hdr", args.sky_cache)
+    image_data = sky_cache.image()
     sky_image = ti.Vector.field(3, dtype=float, shape=(image_data.shape[0], image_data.shape[1]))
     sky_image.from_numpy(image_data)
+    marginal_cdf, conditional_cdf, texel_probs = sky_cache.cached(
+        "distribution", lambda: [array.astype(np.float32) for array in build_sky_distribution(image_data)],
+        build_sky_distribution)
+    sky_marginal_cdf = ti.field(dtype=float, shape=marginal_cdf.shape)
+    sky_conditional_cdf = ti.field(dtype=float, shape=conditional_cdf.shape)
+    sky_texel_probs = ti.field(dtype=float, shape=texel_probs.shape)
+    sky_marginal_cdf.from_numpy(marginal_cdf)
+    sky_conditional_cdf.from_numpy(conditional_cdf)
+    sky_texel_probs.from_numpy(texel_probs)
+    env_sampling = ti.field(dtype=int, shape=())
+    env_sampling[None] = args.env_sampling
+    clamp_samples = ti.field(dtype=int, shape=())
+    clamp_samples[None] = not args.env_sampling
+    sampler = Sampler(args.sampler)
 
-    gui = ti.GUI("Pathtracing", res=(width, height), fast_gui=True)
     colors = ti.Vector.field(3, dtype=float, shape=(width, height))
+    # the pixels render() covers: the whole image, or one tile in a farm worker
+    region = ti.Vector.field(4, dtype=int, shape=())
+    region[None] = (0, 0, width, height)
+    albedos = ti.Vector.field(3, dtype=float, shape=(width, height))
+    normals = ti.Vector.field(3, dtype=float, shape=(width, height))
+    depths = ti.field(dtype=float, shape=(width, height))
     num_spheres = 4
     sphere_centers = ti.Vector.field(3, dtype=float, shape=num_spheres)
     sphere_centers[0] = (0.0, -100.1, 0.0)
@@ -100,9 +487,189 @@ if __name__ == '__main__':
     sphere_materials[2] = LIGHT
     sphere_materials[3] = MIRROR
 
-    frame = 0
-    while gui.running:
-        render(frame)
-        gui.set_image(colors)
-        gui.show()
-        frame += 1
+    from bvh import SphereBVH
+    accel = SphereBVH(sphere_centers, sphere_radiuses)
+
+    # optional triangle mesh: python pathtracing.py data/torus_quad.obj
+    mesh = None
+    mesh_material, mesh_color = DIFFUSE, (0.8, 0.8, 0.8)
+    if args.mesh:
+        from triangle_mesh import load_triangle_mesh
+        mesh = load_triangle_mesh(args.mesh, scale=0.08, offset=(0.0, 0.02, 0.2))
+
+    if args.farm_worker:
+        tile_buffer = TileBuffer(args.tile_size)
+
+        def render_tile(frame, x0, y0, x1, y1):
+            region[None] = (x0, y0, x1, y1)
+            # every frame of the sequence gets its own samples
+            sampler.select(args.sampler, seed=frame)
+            for sample in range(args.samples):
+                render(sample)
+            return tile_buffer.read(colors, x0, y0, x1, y1)
+
+        serve_tiles(render_tile)
+        exit()
+
+    num_pixels = width * height
+    queue_origins = ti.Vector.field(3, dtype=float, shape=(2, num_pixels))
+    queue_directions = ti.Vector.field(3, dtype=float, shape=(2, num_pixels))
+    queue_weights = ti.Vector.field(3, dtype=float, shape=(2, num_pixels))
+    queue_pixels = ti.field(dtype=int, shape=(2, num_pixels))
+    queue_pdfs = ti.field(dtype=float, shape=(2, num_pixels))
+    queue_counts = ti.field(dtype=int, shape=2)
+    hit_positions = ti.Vector.field(3, dtype=float, shape=num_pixels)
+    hit_normals = ti.Vector.field(3, dtype=float, shape=num_pixels)
+    hit_emissions = ti.Vector.field(3, dtype=float, shape=num_pixels)
+    hit_colors = ti.Vector.field(3, dtype=float, shape=num_pixels)
+    material_queues = ti.field(dtype=int, shape=(MIRROR - MISS + 1, num_pixels))
+    material_counts = ti.field(dtype=int, shape=MIRROR - MISS + 1)
+    path_radiances = ti.Vector.field(3, dtype=float, shape=num_pixels)
+
+    min_samples = 16
+    sample_counts = ti.field(dtype=int, shape=(width, height))
+    luminance_means = ti.field(dtype=float, shape=(width, height))
+    luminance_m2 = ti.field(dtype=float, shape=(width, height))
+    active_pixels = ti.field(dtype=int, shape=num_pixels)
+    num_active_pixels = ti.field(dtype=int, shape=())
+
+    def render_until_converged():
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.time_budget:
+            if render_adaptive_pass(args.error_threshold, args.max_samples) == 0:
+                break
+        ti.sync()
+        elapsed = time.perf_counter() - start
+        total_samples = int(sample_counts.to_numpy().sum())
+        print(f"adaptive: {elapsed:.2f} s, {total_samples / num_pixels:.1f} spp on average, "
+              f"{np.count_nonzero(sample_counts.to_numpy() >= args.max_samples)} pixels hit --max-samples")
+        return elapsed, total_samples
+
+    def render_reference(num_frames):
+        # another seed, so the reference shares no samples with the images it is compared to
+        sampler.select("random", seed=1)
+        colors.fill(0.0)
+        for frame in range(num_frames):
+            render(frame)
+        sampler.select(args.sampler)
+        return colors.to_numpy()
+
+    if args.benchmark == "wavefront":
+        from bench_util import measure
+        num_frames = 4
+        images = {}
+        for name, render_frame in [("megakernel", render), ("wavefront", render_wavefront)]:
+            elapsed = measure(lambda: [render_frame(frame) for frame in range(num_frames)], repeat=1)
+            colors.fill(0.0)
+            for frame in range(num_frames):
+                render_frame(frame)
+            images[name] = colors.to_numpy()
+            print(f"{name:>10}: {num_pixels * num_frames / elapsed / 1e6:.2f} M samples/s")
+        print(f"max difference: {abs(images['megakernel'] - images['wavefront']).max():.2e}")
+    elif args.benchmark == "env-sampling":
+        target_error = 0.03
+        # both estimators converge to the same unclamped image
+        clamp_samples[None] = 0
+        env_sampling[None] = 1
+        reference = render_reference(1024)
+        print(f"{'env sampling':>12} {'spp':>5} {'time [s]':>9} {'rmse':>8}")
+        for enabled in [0, 1]:
+            env_sampling[None] = enabled
+            colors.fill(0.0)
+            render(0)  # compile
+            colors.fill(0.0)
+            elapsed, time_to_target = 0.0, None
+            for frame in range(256):
+                ti.sync()
+                start = time.perf_counter()
+                render(frame)
+                ti.sync()
+                elapsed += time.perf_counter() - start
+                rmse = np.sqrt(np.mean((colors.to_numpy() - reference) ** 2))
+                if time_to_target is None and rmse < target_error:
+                    time_to_target = elapsed
+                if (frame + 1) & frame == 0:
+                    print(f"{['off', 'on'][enabled]:>12} {frame + 1:>5} {elapsed:>9.3f} {rmse:>8.5f}")
+            print(f"time to rmse < {target_error}: " + (f"{time_to_target:.3f} s" if time_to_target else "not reached"))
+    elif args.benchmark == "adaptive":
+        reference = render_reference(args.max_samples)
+        colors.fill(0.0)
+        render_adaptive_pass(args.error_threshold, args.max_samples)  # compile
+        for field in [colors, sample_counts, luminance_means, luminance_m2]:
+            field.fill(0)
+        elapsed, total_samples = render_until_converged()
+        adaptive_rmse = np.sqrt(np.mean((colors.to_numpy() - reference) ** 2))
+        colors.fill(0.0)
+        uniform_frames = max(total_samples // num_pixels, 1)
+        for frame in range(uniform_frames):
+            render(frame)
+        uniform_rmse = np.sqrt(np.mean((colors.to_numpy() - reference) ** 2))
+        print(f"rmse at equal sample count: adaptive {adaptive_rmse:.5f}, uniform {uniform_rmse:.5f} ({uniform_frames} spp)")
+    elif args.benchmark == "denoise":
+        from bench_util import measure
+        from denoiser import AtrousDenoiser
+        reference = render_reference(1024)
+        denoiser = AtrousDenoiser(width, height)
+        denoise_time = measure(lambda: denoiser.denoise(colors, albedos, normals, depths))
+        frame_time = measure(lambda: render(0))
+        print(f"denoise: {denoise_time * 1e3:.2f} ms for {width}x{height}, "
+              f"{denoise_time / (num_pixels / 1e6) * 1e3:.2f} ms per megapixel")
+        print(f"{'spp':>5} {'noisy rmse':>11} {'denoised rmse':>14} {'equal-time rmse':>16}")
+        for spp in [1, 4, 8, 16]:
+            colors.fill(0.0)
+            for frame in range(spp):
+                render(frame)
+            noisy_rmse = np.sqrt(np.mean((colors.to_numpy() - reference) ** 2))
+            denoised = denoiser.denoise(colors, albedos, normals, depths).to_numpy()
+            denoised_rmse = np.sqrt(np.mean((denoised - reference) ** 2))
+            # spend the denoising time on more samples instead
+            for frame in range(spp, spp + int(round(denoise_time / frame_time))):
+                render(frame)
+            equal_time_rmse = np.sqrt(np.mean((colors.to_numpy() - reference) ** 2))
+            print(f"{spp:>5} {noisy_rmse:>11.5f} {denoised_rmse:>14.5f} {equal_time_rmse:>16.5f}")
+    elif args.benchmark == "sampler":
+        # the reference uses a different seed so it shares no samples with the runs below
+        sampler.select("random", seed=1)
+        for frame in range(1024):
+            render(frame)
+        reference = colors.to_numpy()
+        spps = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+        errors = {}
+        for kind in SAMPLERS:
+            sampler.select(kind)
+            colors.fill(0.0)
+            errors[kind] = []
+            for frame in range(spps[-1]):
+                render(frame)
+                if frame + 1 in spps:
+                    errors[kind].append(np.sqrt(np.mean((colors.to_numpy() - reference) ** 2)))
+        print(f"{'spp':>5}" + "".join(f" {kind + ' rmse':>12}" for kind in SAMPLERS))
+        for k, spp in enumerate(spps):
+            print(f"{spp:>5}" + "".join(f" {errors[kind][k]:>12.5f}" for kind in SAMPLERS))
+        for kind in SAMPLERS:
+            slope = np.polyfit(np.log(spps), np.log(errors[kind]), 1)[0]
+            print(f"{kind}: rmse ~ spp^{slope:.2f}")
+    else:
+        gui = ti.GUI("Pathtracing", res=(width, height), fast_gui=True)
+        if args.denoise:
+            from denoiser import AtrousDenoiser
+            denoiser = AtrousDenoiser(width, height)
+        frame = 0
+        adaptive_start = time.perf_counter()
+        adaptive_done = False
+        while gui.running:
+            if args.adaptive:
+                # one pass per frame keeps the window responsive while the image converges
+                if not adaptive_done:
+                    adaptive_done = (render_adaptive_pass(args.error_threshold, args.max_samples) == 0
+                                     or time.perf_counter() - adaptive_start >= args.time_budget)
+            elif args.wavefront:
+                render_wavefront(frame)
+            else:
+                render(frame)
+            gui.set_image(denoiser.denoise(colors, albedos, normals, depths) if args.denoise else colors)
+            gui.show()
+            frame += 1
+        if args.save_buffers:
+            np.savez(args.save_buffers, colors=colors.to_numpy(), albedos=albedos.to_numpy(),
+                     normals=normals.to_numpy(), depths=depths.to_numpy())
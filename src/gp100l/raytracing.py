@@ -1,3 +1,5 @@
+import argparse
+import math
 import taichi as ti
 eps = 0.00001
 
@@ -24,7 +26,10 @@ def intersect_sphere(origin, direction, sphere_center, sphere_radius):
 
 
 @ti.func
-def intersect_spheres(origin, direction, sphere_centers, sphere_radiuses):
+def intersect_spheres(origin, direction, sphere_centers, sphere_radiuses, accel: ti.template() = None):
+    if ti.static(bool(accel)):
+        return accel.intersect(origin, direction)
+
     hit_distance = 10000.0
     hit_position = ti.Vector([0.0, 0.0, 0.0])
     hit_normal = ti.Vector([0.0, 0.0, 0.0])
@@ -39,6 +44,36 @@ def intersect_spheres(origin, direction, sphere_centers, sphere_radiuses):
     return hit_distance, hit_position, hit_normal, hit_sphere
 
 
+@ti.func
+def occluded_sphere(origin, direction, max_distance, sphere_center, sphere_radius):
+    # any hit in (eps, max_distance), without the hit position and normal
+    oc = sphere_center - origin
+    b = ti.math.dot(oc, direction)
+    det = b * b - ti.math.dot(oc, oc) + sphere_radius * sphere_radius
+    hit = False
+    if det > 0.0:
+        sqrt_det = ti.math.sqrt(det)
+        t = b - sqrt_det
+        if t <= eps:
+            t = b + sqrt_det
+        hit = eps < t < max_distance
+    return hit
+
+
+@ti.func
+def occluded(origin, direction, max_distance, sphere_centers, sphere_radiuses, accel: ti.template() = None):
+    # shadow rays only need to know whether anything blocks them, so stop at the first hit
+    if ti.static(bool(accel)):
+        return accel.occluded(origin, direction, max_distance)
+
+    hit = False
+    for s in range(sphere_centers.shape[0]):
+        if occluded_sphere(origin, direction, max_distance, sphere_centers[s], sphere_radiuses[s]):
+            hit = True
+            break
+    return hit
+
+
 @ti.func
 def reflect(dir, normal):
     return dir - 2 * ti.math.dot(dir, normal) * normal
@@ -46,15 +81,14 @@ def reflect(dir, normal):
 
 @ti.kernel
 def render():
-    light_position = ti.Vector([10, 10, 10])
-    for i, j in colors:
+    for i, j in ti.ndrange((region[None][0], region[None][2]), (region[None][1], region[None][3])):
         screen_position = ti.Vector([i / width - 0.5, j / height - 0.5, 0])
         origin = ti.Vector([0.0, 0.0, 1.0])
         direction = ti.math.normalize(screen_position - origin)
         color = ti.Vector([0.0, 0.0, 0.0])
         weight = ti.Vector([1.0, 1.0, 1.0])
         for depth in range(4):
-            _, hit_position, hit_normal, hit_sphere = intersect_spheres(origin, direction, sphere_centers, sphere_radiuses)
+            _, hit_position, hit_normal, hit_sphere = intersect_spheres(origin, direction, sphere_centers, sphere_radiuses, accel)
             if hit_sphere == -1:
                 color = weight * ti.Vector([0.8, 0.9, 1.0])
                 break
@@ -65,11 +99,15 @@ def render():
                 color = weight * sphere_emission
                 break
             elif material == DIFFUSE:
-                light_direction = ti.math.normalize(light_position - hit_position)
+                # one batch of shadow queries per hit point, one occlusion test per light
                 origin = hit_position + hit_normal * 0.001
-                hit_sphere = intersect_spheres(origin, light_direction, sphere_centers, sphere_radiuses)[3]
-                if hit_sphere == -1:
-                    color = weight * sphere_color * ti.math.dot(hit_normal, light_direction)
+                for l in range(light_positions.shape[0]):
+                    to_light = light_positions[l] - origin
+                    light_distance = ti.math.length(to_light)
+                    light_direction = to_light / light_distance
+                    cos_light = ti.math.dot(hit_normal, light_direction)
+                    if cos_light > 0.0 and not occluded(origin, light_direction, light_distance, sphere_centers, sphere_radiuses, accel):
+                        color += weight * sphere_color * light_colors[l] * cos_light
                 break
             elif material == MIRROR:
                 direction = reflect(direction, hit_normal)
@@ -80,11 +118,30 @@ def render():
 
 
 if __name__ == '__main__':
-    ti.init(arch=ti.vulkan)
+    from render_farm import add_farm_arguments, run_farm, serve_tiles, worker_threads, TileBuffer
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lights", type=int, default=1, help="number of point lights")
+    add_farm_arguments(parser)
+    args = parser.parse_args()
+
     width, height = 1024, 1024
+    if args.workers and not args.farm_worker:
+        run_farm(args, width, height)
+        exit()
+
+    ti.init(arch=ti.cpu if args.farm_worker else ti.vulkan, cpu_max_num_threads=worker_threads(args))
     LIGHT, DIFFUSE, MIRROR, GLASS = 0, 1, 2, 3
-    gui = ti.GUI("Raytracing", res=(width, height), fast_gui=True)
     colors = ti.Vector.field(3, dtype=float, shape=(width, height))
+    # the pixels render() covers: the whole image, or one tile in a farm worker
+    region = ti.Vector.field(4, dtype=int, shape=())
+    region[None] = (0, 0, width, height)
+    # point lights on a circle around the original light at (10, 10, 10)
+    light_positions = ti.Vector.field(3, dtype=float, shape=args.lights)
+    light_colors = ti.Vector.field(3, dtype=float, shape=args.lights)
+    for l in range(args.lights):
+        angle = math.pi / 4 + 2.0 * math.pi * l / args.lights
+        light_positions[l] = (10.0 * math.sqrt(2.0) * math.cos(angle), 10.0, 10.0 * math.sqrt(2.0) * math.sin(angle))
+        light_colors[l] = (1.0 / args.lights, 1.0 / args.lights, 1.0 / args.lights)
     num_spheres = 4
     sphere_centers = ti.Vector.field(3, dtype=float, shape=num_spheres)
     sphere_centers[0] = (0.0, -100.1, 0.0)
@@ -108,6 +165,22 @@ if __name__ == '__main__':
     sphere_materials[1] = DIFFUSE
     sphere_materials[2] = LIGHT
     sphere_materials[3] = MIRROR
+
+    from bvh import SphereBVH
+    accel = SphereBVH(sphere_centers, sphere_radiuses)
+
+    if args.farm_worker:
+        tile_buffer = TileBuffer(args.tile_size)
+
+        def render_tile(frame, x0, y0, x1, y1):
+            region[None] = (x0, y0, x1, y1)
+            render()
+            return tile_buffer.read(colors, x0, y0, x1, y1)
+
+        serve_tiles(render_tile)
+        exit()
+
+    gui = ti.GUI("Raytracing", res=(width, height), fast_gui=True)
     while gui.running:
         render()
         gui.set_image(colors)
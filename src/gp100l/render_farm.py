@@ -0,0 +1,236 @@
+# Tile render farm
+# The scheduler splits a frame sequence into tiles and hands them to a pool of worker processes,
+# each with its own Taichi runtime. Workers are the renderer scripts themselves, started with
+# --farm-worker: they build the scene as usual and then render whatever tiles they are sent.
+# A tile whose worker dies is sent again to a fresh worker, and finished tiles can be kept in a
+# checkpoint directory so that an interrupted run resumes where it stopped. The tiles go into a
+# subdirectory named by a hash of the script and the arguments that change the image, so a run
+# with other settings does not pick up stale tiles.
+#
+#   python raytracing.py --workers 4 --output image.png
+#   python pathtracing.py --workers 4 --samples 256 --frames 8 --checkpoint farm --output frames.npy
+#   python pathtracing.py --workers 8 --scaling
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import runpy
+import sys
+import time
+from collections import deque
+from multiprocessing.connection import wait
+import numpy as np
+import taichi as ti
+
+_connection = None
+# farm options, with and without a value, that do not change the pixels of a tile
+_SCHEDULING_OPTIONS = {"--workers", "--tile-size", "--frames", "--checkpoint", "--output"}
+_SCHEDULING_FLAGS = {"--scaling", "--farm-worker"}
+
+
+def add_farm_arguments(parser):
+    group = parser.add_argument_group("render farm")
+    group.add_argument("--workers", type=int, default=0, help="render tiles in this many processes instead of opening a window")
+    group.add_argument("--tile-size", type=int, default=64)
+    group.add_argument("--frames", type=int, default=1, help="length of the frame sequence")
+    group.add_argument("--checkpoint", help="directory for finished tiles; run again with the same one to resume")
+    group.add_argument("--output", help=".npy file with all frames, or an image file per frame")
+    group.add_argument("--scaling", action="store_true", help="report throughput with 1, 2, 4, ... --workers processes")
+    group.add_argument("--farm-worker", action="store_true", help=argparse.SUPPRESS)
+
+
+def worker_threads(args):
+    # the workers share the cores instead of each one starting a thread per core
+    num_cores = os.cpu_count() or 1
+    return max(num_cores // args.workers, 1) if args.farm_worker else num_cores
+
+
+@ti.data_oriented
+class TileBuffer:
+    def __init__(self, tile_size):
+        self.pixels = ti.Vector.field(3, dtype=float, shape=(tile_size, tile_size))
+
+    @ti.kernel
+    def copy(self, image: ti.template(), x0: int, y0: int):
+        for i, j in self.pixels:
+            if x0 + i < image.shape[0] and y0 + j < image.shape[1]:
+                self.pixels[i, j] = image[x0 + i, y0 + j]
+
+    def read(self, image, x0, y0, x1, y1):
+        # only the tile leaves the device, not the whole framebuffer
+        self.copy(image, x0, y0)
+        return self.pixels.to_numpy()[:x1 - x0, :y1 - y0]
+
+
+def serve_tiles(render_tile):
+    # worker loop: render_tile(frame, x0, y0, x1, y1) returns an (x1 - x0, y1 - y0, 3) array
+    while True:
+        job = _connection.recv()
+        if job is None:
+            break
+        _connection.send((job, render_tile(*job)))
+
+
+def render_digest(script, argv):
+    # the script source, the image-affecting arguments and the contents of files they name (a mesh)
+    digest = hashlib.blake2b(digest_size=8)
+    with open(script, "rb") as f:
+        digest.update(f.read())
+    skip = False
+    for argument in argv:
+        if skip:
+            skip = False
+            continue
+        option = argument.split("=", 1)[0]
+        if option in _SCHEDULING_FLAGS or option in _SCHEDULING_OPTIONS:
+            skip = option in _SCHEDULING_OPTIONS and "=" not in argument
+            continue
+        digest.update(argument.encode() + b"\0")
+        if os.path.isfile(argument):
+            with open(argument, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _run_worker(script, argv, connection):
+    global _connection
+    _connection = connection
+    sys.argv = [script] + argv
+    runpy.run_path(script, run_name="__main__")
+
+
+class RenderFarm:
+    def __init__(self, script, argv, width, height, tile_size=64, num_workers=1, checkpoint=None, max_attempts=3):
+        self.script = script
+        self.argv = argv
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.num_workers = num_workers
+        self.checkpoint = checkpoint
+        self.max_attempts = max_attempts
+        self.context = multiprocessing.get_context("spawn")
+        if checkpoint:
+            self.checkpoint = os.path.join(checkpoint, render_digest(script, argv))
+            os.makedirs(self.checkpoint, exist_ok=True)
+
+    def tiles(self, num_frames):
+        return [(frame, x, y, min(x + self.tile_size, self.width), min(y + self.tile_size, self.height))
+                for frame in range(num_frames)
+                for x in range(0, self.width, self.tile_size)
+                for y in range(0, self.height, self.tile_size)]
+
+    def checkpoint_path(self, job):
+        return os.path.join(self.checkpoint, "{:04d}_{}_{}_{}_{}.npy".format(*job))
+
+    def start_worker(self):
+        argv = self.argv + ["--farm-worker", "--workers", str(self.num_workers), "--tile-size", str(self.tile_size)]
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(target=_run_worker, args=(self.script, argv, child_connection), daemon=True)
+        process.start()
+        child_connection.close()
+        return connection, process
+
+    def render(self, num_frames=1):
+        images = np.zeros((num_frames, self.width, self.height, 3), dtype=np.float32)
+        pending = deque()
+        for job in self.tiles(num_frames):
+            frame, x0, y0, x1, y1 = job
+            if self.checkpoint and os.path.exists(self.checkpoint_path(job)):
+                images[frame, x0:x1, y0:y1] = np.load(self.checkpoint_path(job))
+            else:
+                pending.append(job)
+        num_tiles = len(pending)
+        if num_tiles == 0:
+            return images
+
+        # connection -> (process, job in flight)
+        workers = {}
+        attempts = {}
+
+        def dispatch(connection, process):
+            job = pending.popleft() if pending else None
+            try:
+                connection.send(job)
+            except ConnectionError:
+                # the worker died right after its last tile, give the next one to a new worker
+                process.join()
+                connection.close()
+                if job is not None:
+                    pending.appendleft(job)
+                    dispatch(*self.start_worker())
+                return
+            if job is None:
+                process.join()
+                connection.close()
+            else:
+                workers[connection] = (process, job)
+
+        for _ in range(min(self.num_workers, num_tiles)):
+            dispatch(*self.start_worker())
+        while workers:
+            ready = wait(list(workers) + [process.sentinel for process, _ in workers.values()])
+            for connection, (process, job) in list(workers.items()):
+                if connection not in ready and process.sentinel not in ready:
+                    continue
+                del workers[connection]
+                try:
+                    done_job, tile = connection.recv()
+                except (EOFError, ConnectionError):
+                    process.join()
+                    connection.close()
+                    attempts[job] = attempts.get(job, 0) + 1
+                    if attempts[job] >= self.max_attempts:
+                        raise RuntimeError(f"tile {job} crashed {attempts[job]} workers (exit code {process.exitcode})")
+                    print(f"worker {process.pid} exited with {process.exitcode}, sending tile {job} again")
+                    pending.appendleft(job)
+                    dispatch(*self.start_worker())
+                    continue
+                frame, x0, y0, x1, y1 = done_job
+                images[frame, x0:x1, y0:y1] = tile
+                if self.checkpoint:
+                    path = self.checkpoint_path(done_job)
+                    np.save(path + ".tmp.npy", tile)
+                    os.replace(path + ".tmp.npy", path)
+                dispatch(connection, process)
+        return images
+
+
+def save_frames(file_path, images):
+    if file_path.endswith(".npy"):
+        np.save(file_path, images)
+        return
+    stem, extension = os.path.splitext(file_path)
+    for frame, image in enumerate(images):
+        path = file_path if len(images) == 1 else f"{stem}_{frame:04d}{extension}"
+        ti.tools.imwrite(np.clip(image, 0.0, 1.0), path)
+
+
+def run_farm(args, width, height):
+    script, argv = os.path.abspath(sys.argv[0]), sys.argv[1:]
+    if args.scaling:
+        num_workers = [1]
+        while num_workers[-1] * 2 <= args.workers:
+            num_workers.append(num_workers[-1] * 2)
+        if num_workers[-1] != args.workers:
+            num_workers.append(args.workers)
+        num_pixels = args.frames * width * height
+        print(f"{os.cpu_count()} cores, {width}x{height}, {args.frames} frames, {args.tile_size}x{args.tile_size} tiles")
+        print(f"{'workers':>7} {'time [s]':>9} {'Mpixels/s':>10} {'speedup':>8}")
+        baseline = None
+        for n in num_workers:
+            farm = RenderFarm(script, argv, width, height, args.tile_size, n)
+            start = time.perf_counter()
+            farm.render(args.frames)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{n:>7} {elapsed:>9.2f} {num_pixels / elapsed / 1e6:>10.3f} {baseline / elapsed:>8.2f}")
+        return
+
+    farm = RenderFarm(script, argv, width, height, args.tile_size, args.workers, args.checkpoint)
+    start = time.perf_counter()
+    images = farm.render(args.frames)
+    print(f"rendered {args.frames} frames with {args.workers} workers in {time.perf_counter() - start:.2f} s")
+    if args.output:
+        save_frames(args.output, images)
@@ -0,0 +1,56 @@
+# Shared sample generator for the Monte Carlo renderers
+# sample(pixel, index, dimension) returns the dimension-th coordinate of the index-th sample of a pixel.
+# "random": white noise from a counter-based hash, the same statistics as ti.random() but reproducible.
+# "rd": the R_d quasirandom sequence (rd_sequence.py), Cranley-Patterson rotated per pixel and dimension
+#       so that neighbouring pixels do not share the same point set.
+#       Only the first rd_dimension dimensions (e.g. the first bounce direction) are stratified. The others are
+#       padded with R_d points at a hashed index: with a plain rotation they would be shifted copies of the
+#       first ones, and that per-pixel correlation stops the error from going down. A single 32-dimensional
+#       R_d has poorly spread 2D projections (its alphas are all close to 1) and was slower than white noise.
+
+import numpy as np
+import taichi as ti
+from rd_sequence import RdGenerator
+
+SAMPLERS = ["random", "rd"]
+
+
+@ti.func
+def pcg_hash(x):
+    state = x * ti.u32(747796405) + ti.u32(2891336453)
+    word = ((state >> ((state >> ti.u32(28)) + ti.u32(4))) ^ state) * ti.u32(277803737)
+    return (word >> ti.u32(22)) ^ word
+
+
+@ti.data_oriented
+class Sampler:
+    def __init__(self, kind="random", seed=0, rd_dimension=2):
+        generator = RdGenerator(rd_dimension, 0.5)
+        self.rd_dimension = rd_dimension
+        # R_d in 0.32 fixed point: the u32 wrap-around is the "mod 1", exact for any sample index
+        self.rd_seed = int(generator.seed * 2.0 ** 32)
+        self.rd_alpha = ti.field(dtype=ti.u32, shape=rd_dimension)
+        self.rd_alpha.from_numpy(np.floor(generator.alpha * 2.0 ** 32).astype(np.uint64).astype(np.uint32))
+        self.kind = ti.field(dtype=int, shape=())
+        self.seed = ti.field(dtype=ti.u32, shape=())
+        self.select(kind, seed)
+
+    def select(self, kind, seed=0):
+        # runtime switch, kernels that already use the sampler do not need to be recompiled
+        self.kind[None] = SAMPLERS.index(kind)
+        self.seed[None] = seed
+
+    @ti.func
+    def sample(self, pixel, index, dimension):
+        key = pcg_hash(ti.u32(pixel) ^ pcg_hash(ti.u32(dimension) ^ pcg_hash(self.seed[None])))
+        x = ti.u32(0)
+        if self.kind[None] == 0:
+            x = pcg_hash(key ^ pcg_hash(ti.u32(index)))
+        else:
+            sequence_index = ti.u32(index)
+            if dimension >= self.rd_dimension:
+                # both coordinates of a padded point share the index
+                pair = ti.u32(dimension // self.rd_dimension)
+                sequence_index = pcg_hash(sequence_index ^ pcg_hash(ti.u32(pixel) ^ pcg_hash(~pair ^ self.seed[None])))
+            x = ti.u32(self.rd_seed) + (sequence_index + ti.u32(1)) * self.rd_alpha[dimension % self.rd_dimension] + key
+        return float(x >> ti.u32(8)) / 16777216.0
@@ -0,0 +1,113 @@
+# Cached environment map loading
+# Decoding a large HDR on every launch is slow, so the decoded float32 texels (and anything derived
+# from them, e.g. the sampling CDFs) are written once as .npy files and memory-mapped on later runs.
+# Cache entries are keyed by a hash of the file contents; the hash itself is remembered together with
+# the file's size and mtime, so an unchanged file is not even read again. The key also holds
+# CACHE_VERSION and a hash of the source of the function that builds the entry, so a change to the
+# decoding or to e.g. build_sky_distribution does not keep serving stale arrays.
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+import numpy as np
+import taichi as ti
+
+# bump when the layout of the entries or the decoding of the image changes
+CACHE_VERSION = 1
+
+
+class SkyCache:
+    def __init__(self, file_path, cache_dir=None):
+        self.file_path = file_path
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(file_path), ".sky_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.name = os.path.splitext(os.path.basename(file_path))[0]
+        self.digest = self.file_digest()
+
+    def file_digest(self):
+        stat = os.stat(self.file_path)
+        index_path = os.path.join(self.cache_dir, self.name + ".json")
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                return index["digest"]
+
+        sha1 = hashlib.sha1()
+        with open(self.file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                sha1.update(block)
+        index = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": sha1.hexdigest()[:16]}
+        with open(f"{index_path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(f"{index_path}.{os.getpid()}.tmp", index_path)
+        return index["digest"]
+
+    def cached(self, key, compute, builder=None):
+        # compute() returns a list of arrays; they are stored once and memory-mapped from then on.
+        # builder is the function compute() calls to make them, its source is part of the key.
+        version = f"v{CACHE_VERSION}"
+        if builder is not None:
+            version += "-" + hashlib.sha1(inspect.getsource(builder).encode()).hexdigest()[:8]
+        prefix = os.path.join(self.cache_dir, f"{self.name}-{self.digest}-{key}-{version}")
+        if not os.path.exists(prefix + ".count"):
+            arrays = compute()
+            for k, array in enumerate(arrays):
+                # farm workers may fill the same entry at once, each through its own temporary file
+                np.save(f"{prefix}-{k}.{os.getpid()}.tmp.npy", np.ascontiguousarray(array))
+                os.replace(f"{prefix}-{k}.{os.getpid()}.tmp.npy", f"{prefix}-{k}.npy")
+            # written last, so an interrupted run never leaves a partial entry behind
+            with open(f"{prefix}.{os.getpid()}.tmp", "w") as f:
+                f.write(str(len(arrays)))
+            os.replace(f"{prefix}.{os.getpid()}.tmp", prefix + ".count")
+        with open(prefix + ".count") as f:
+            count = int(f.read())
+        return [np.load(f"{prefix}-{k}.npy", mmap_mode="r") for k in range(count)]
+
+    def image(self):
+        # same values as ti.tools.imread, stored as float32
+        return self.cached("image", lambda: [ti.tools.imread(self.file_path, 3).astype(np.float32)])[0]
+
+
+if __name__ == '__main__':
+    # cold vs warm startup: python sky_cache.py [image]
+    import shutil
+    import tempfile
+    from pathtracing import build_sky_distribution
+
+    file_path = sys.argv[1] if len(sys.argv) > 1 else "data/modern_buildings_2_2k.hdr"
+    ti.init(arch=ti.cpu)
+
+    def startup(cache_dir):
+        start = time.perf_counter()
+        if cache_dir is None:
+            image_data = ti.tools.imread(file_path, 3)
+            distribution = [a.astype(np.float32) for a in build_sky_distribution(image_data)]
+        else:
+            sky = SkyCache(file_path, cache_dir)
+            image_data = sky.image()
+            distribution = sky.cached("distribution", lambda: [a.astype(np.float32) for a in build_sky_distribution(image_data)],
+                                      build_sky_distribution)
+        sky_image = ti.Vector.field(3, dtype=float, shape=image_data.shape[:2])
+        sky_image.from_numpy(image_data)
+        for array in distribution:
+            field = ti.field(dtype=float, shape=array.shape)
+            field.from_numpy(array)
+        ti.sync()
+        return time.perf_counter() - start
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        print(f"{file_path}: {os.path.getsize(file_path) / 2 ** 20:.1f} MiB")
+        startup(None)  # warm up the file system cache and Taichi
+        print(f"no cache:       {startup(None) * 1e3:8.1f} ms")
+        print(f"cold cache:     {startup(cache_dir) * 1e3:8.1f} ms")
+        print(f"warm cache:     {startup(cache_dir) * 1e3:8.1f} ms")
+        # as after a touch or copy: the file is hashed again, the entry is reused
+        os.remove(os.path.join(cache_dir, os.path.splitext(os.path.basename(file_path))[0] + ".json"))
+        print(f"rehashed file:  {startup(cache_dir) * 1e3:8.1f} ms")
+    finally:
+        shutil.rmtree(cache_dir)
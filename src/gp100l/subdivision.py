@@ -1,3 +1,8 @@
+import argparse
+import collections
+import hashlib
+import time
+import numpy as np
 import taichi as ti
 import halfedge as he
 from obj_loader import load_obj
@@ -5,8 +10,11 @@ from obj_loader import load_obj
 
 class Mesh:
     def __init__(self, file_path):
-        vertex_positions, face_indices = load_obj(file_path)
-        self.vertices, self.faces, self.edges = he.build_half_edges(vertex_positions, face_indices)
+        self.set_half_edges(he.HalfEdgeMesh(*load_obj(file_path)))
+
+    def set_half_edges(self, half_edges):
+        self.half_edges = half_edges
+        self.vertices, self.faces, self.edges = half_edges.vertices, half_edges.faces, half_edges.edges
 
     def get_both_vertices(self, e):
         return self.edges[e].origin, self.edges[self.edges[e].next].origin
@@ -34,10 +42,10 @@ class Mesh:
                 break
 
     def all_unique_edges(self):
-        unique_edges = []
+        unique_edges = set()
         for e in range(len(self.edges)):
             if not self.edges[e].twin in unique_edges:
-                unique_edges.append(e)
+                unique_edges.add(e)
                 yield e
 
 
@@ -131,11 +139,308 @@ def subdivide(mesh):
                        face_to_face_points[f],
                        edge_to_edge_points[es[i-1]]]
             face_indices.append(indices)
-    mesh.vertices, mesh.faces, mesh.edges = he.build_half_edges(vertex_positions, face_indices)
+    mesh.set_half_edges(he.HalfEdgeMesh(vertex_positions, face_indices))
     return face_points, edge_points
 
 
+# Catmull-Clark on the arrays of a HalfEdgeMesh: the refined quads are index arrays and the new
+# positions are a sparse matrix (the stencil) times the old ones, S @ P. The vertices are numbered
+# like subdivide() does: the moved original vertices, one edge point per edge, one face point per face.
+# Boundary edges get their midpoint and boundary vertices 3/4 of themselves and 1/8 of their two
+# boundary neighbors, the usual boundary rules, which subdivide() does not have.
+
+
+class Stencil:
+    # a sparse matrix in CSR form; entries with the same row and column are summed.
+    # Every row needs an entry (np.add.reduceat).
+    def __init__(self, rows, columns, weights, shape):
+        keys, inverse = np.unique(rows.astype(np.int64) * shape[1] + columns, return_inverse=True)
+        self.weights = np.bincount(inverse, weights=weights).astype(np.float32)
+        self.columns = (keys % shape[1]).astype(np.int32)
+        self.row_offsets = np.searchsorted(keys // shape[1], np.arange(shape[0] + 1)).astype(np.int32)
+        self.shape = shape
+        assert np.all(np.diff(self.row_offsets) > 0), "a row without entries"
+
+    def __matmul__(self, positions):
+        return np.add.reduceat(self.weights[:, None] * positions[self.columns], self.row_offsets[:-1], axis=0)
+
+
+def face_corners(mesh, edges):
+    # every half-edge of the faces of the given half-edges: for each e, all h with face[h] == face[e]
+    face = mesh.face[edges]
+    sizes = np.diff(np.append(mesh.face_edge, len(mesh.origin)))[face]
+    repeated = np.repeat(np.arange(len(edges)), sizes)
+    offset = np.arange(len(repeated)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return repeated, mesh.face_edge[face][repeated] + offset, sizes[repeated]
+
+
+def refine(mesh):
+    # one level: the stencil from the old to the new vertices and the new faces, an (E, 4) array
+    num_vertices, num_faces, num_edges = len(mesh.positions), len(mesh.face_edge), len(mesh.origin)
+    edge = np.arange(num_edges)
+    unique = np.flatnonzero((mesh.twin == -1) | (edge < mesh.twin))
+    edge_id = np.empty(num_edges, dtype=np.int64)
+    edge_id[unique] = np.arange(len(unique))
+    paired = mesh.twin[unique] != -1
+    edge_id[mesh.twin[unique][paired]] = np.flatnonzero(paired)
+    edge_point = num_vertices + edge_id
+    face_point = num_vertices + len(unique) + mesh.face
+    destination = mesh.origin[mesh.next]
+    boundary = mesh.twin == -1
+    rows, columns, weights = [], [], []
+
+    def add(row, column, weight):
+        rows.append(row)
+        columns.append(column)
+        weights.append(np.broadcast_to(weight, np.shape(row)))
+
+    # face points: the average of the face
+    owner, corner, size = face_corners(mesh, mesh.face_edge)
+    add(face_point[corner], mesh.origin[corner], 1.0 / size)
+    # edge points: the average of both ends and both face points, each half-edge adds its origin and
+    # its face; boundary edges the midpoint
+    add(edge_point, mesh.origin, np.where(boundary, 0.5, 0.25))
+    add(edge_point[boundary], destination[boundary], 0.5)
+    inner = np.flatnonzero(~boundary)
+    owner, corner, size = face_corners(mesh, inner)
+    add(edge_point[inner][owner], mesh.origin[corner], 0.25 / size)
+    # vertices: (F + 2 R + (k - 3) v) / k with the averages F of the face points and R of the edge
+    # midpoints around v, that is (k - 2) / k v, 1 / k^2 for each neighbor and 1 / k^2 for each face point
+    valence = np.bincount(mesh.origin, minlength=num_vertices).astype(np.float64)
+    on_boundary = np.zeros(num_vertices, dtype=bool)
+    on_boundary[mesh.origin[boundary]] = True
+    on_boundary[destination[boundary]] = True
+    vertex = np.arange(num_vertices)
+    add(vertex, vertex, np.where(on_boundary, 0.75, np.where(valence > 0, (valence - 2) / np.maximum(valence, 1), 1.0)))
+    interior = np.flatnonzero(~on_boundary[mesh.origin])
+    k = valence[mesh.origin[interior]]
+    add(mesh.origin[interior], destination[interior], 1.0 / k ** 2)
+    owner, corner, size = face_corners(mesh, interior)
+    add(mesh.origin[interior][owner], mesh.origin[corner], 1.0 / (k[owner] ** 2 * size))
+    add(mesh.origin[boundary], destination[boundary], 0.125)
+    add(destination[boundary], mesh.origin[boundary], 0.125)
+    num_new_vertices = num_vertices + len(unique) + num_faces
+    stencil = Stencil(np.concatenate(rows), np.concatenate(columns), np.concatenate(weights),
+                      (num_new_vertices, num_vertices))
+
+    # a quad per half-edge, in the order of subdivide(): per face from its second half-edge on
+    e = mesh.next
+    faces = np.stack([mesh.origin[e], edge_point[e], face_point[e], edge_point[mesh.prev[e]]], axis=-1)
+    return stencil, faces.astype(np.int32)
+
+
+def subdivide_arrays(vertex_positions, face_indices, levels=1):
+    # positions (V, 3) and faces (F, 4) after the given number of levels, and the stencil of each level
+    if levels < 1:
+        raise ValueError(f"levels must be at least 1, got {levels}")
+    mesh = he.HalfEdgeMesh(vertex_positions, face_indices)
+    positions = mesh.positions
+    stencils = []
+    for level in range(levels):
+        stencil, faces = refine(mesh)
+        positions = stencil @ positions
+        stencils.append(stencil)
+        if level < levels - 1:
+            mesh = he.HalfEdgeMesh(positions, faces)
+    return positions, faces, stencils
+
+
+@ti.data_oriented
+class SubdivisionPlan:
+    # The refined topology and the stencils of some levels of subdivide_arrays() for one set of faces,
+    # built once. evaluate() subdivides any positions of those vertices with one Taichi kernel
+    # launch per level (a sparse matrix times the positions); the result is a field to render.
+    def __init__(self, face_indices, num_vertices, levels):
+        if levels < 1:
+            raise ValueError(f"levels must be at least 1, got {levels}")
+        mesh = he.HalfEdgeMesh(np.zeros((num_vertices, 3), dtype=np.float32), face_indices)
+        stencils = []
+        for level in range(levels):
+            stencil, faces = refine(mesh)
+            stencils.append(stencil)
+            if level < levels - 1:
+                mesh = he.HalfEdgeMesh(np.zeros((stencil.shape[0], 3), dtype=np.float32), faces)
+        self.faces = faces
+        # the fields of a plan are a tree of their own, which release() frees; Taichi does not free it
+        # when the plan is garbage-collected
+        builder = ti.FieldsBuilder()
+        self.positions = [self.place(builder, ti.Vector.field(3, dtype=float), num_vertices)]
+        self.levels = []
+        for stencil in stencils:
+            self.levels.append([self.place(builder, ti.field(ti.i32), len(stencil.row_offsets)),
+                                self.place(builder, ti.field(ti.i32), len(stencil.columns)),
+                                self.place(builder, ti.field(ti.f32), len(stencil.weights))])
+            self.positions.append(self.place(builder, ti.Vector.field(3, dtype=float), stencil.shape[0]))
+        self.trees = [builder.finalize()]
+        for stencil, fields in zip(stencils, self.levels):
+            for field, array in zip(fields, [stencil.row_offsets, stencil.columns, stencil.weights]):
+                field.from_numpy(array)
+        self.triangle_indices = None
+        self.released = False
+
+    @staticmethod
+    def place(builder, field, size):
+        builder.dense(ti.i, size).place(field)
+        return field
+
+    def release(self):
+        # destroys the fields, including those evaluate() and triangles() returned
+        for tree in self.trees:
+            tree.destroy()
+        self.trees = []
+        self.released = True
+
+    def check_alive(self):
+        if self.released:
+            raise RuntimeError("the SubdivisionPlan was released, its fields are gone")
+
+    @ti.kernel
+    def apply(self, row_offsets: ti.template(), columns: ti.template(), weights: ti.template(),
+              positions: ti.template(), result: ti.template()):
+        for row in result:
+            total = ti.Vector([0.0, 0.0, 0.0])
+            for k in range(row_offsets[row], row_offsets[row + 1]):
+                total += weights[k] * positions[columns[k]]
+            result[row] = total
+
+    def evaluate(self, positions):
+        # positions: an (V, 3) array; returns the field of the subdivided positions, which is reused
+        self.check_alive()
+        self.positions[0].from_numpy(np.asarray(positions, dtype=np.float32))
+        for level, fields in enumerate(self.levels):
+            self.apply(*fields, self.positions[level], self.positions[level + 1])
+        return self.positions[-1]
+
+    def triangles(self):
+        # the index field for scene.mesh, two triangles per quad, made on the first call
+        self.check_alive()
+        if self.triangle_indices is None:
+            triangles = self.faces[:, [0, 1, 2, 0, 2, 3]]
+            builder = ti.FieldsBuilder()
+            self.triangle_indices = self.place(builder, ti.field(ti.i32), triangles.size)
+            self.trees.append(builder.finalize())
+            self.triangle_indices.from_numpy(triangles.ravel())
+        return self.triangle_indices
+
+
+class PlanCache:
+    # SubdivisionPlans by a hash of the face indices, the least recently used one goes first.
+    # An evicted plan is only dropped from the cache, not released, since a caller may still render with
+    # it; release() a plan once it is no longer drawn to free its fields.
+    def __init__(self, max_plans=4):
+        self.max_plans = max_plans
+        self.plans = collections.OrderedDict()
+
+    def plan(self, face_indices, num_vertices, levels):
+        if isinstance(face_indices, np.ndarray):
+            faces = np.ascontiguousarray(face_indices, dtype=np.int32)
+            sizes = np.full(len(faces), faces.shape[-1], dtype=np.int32)
+        else:
+            faces = np.array([v for indices in face_indices for v in indices], dtype=np.int32)
+            sizes = np.array([len(indices) for indices in face_indices], dtype=np.int32)
+        digest = hashlib.blake2b(faces.tobytes() + sizes.tobytes(), digest_size=16).hexdigest()
+        key = (digest, num_vertices, levels)
+        if key in self.plans:
+            self.plans.move_to_end(key)
+        else:
+            self.plans[key] = SubdivisionPlan(face_indices, num_vertices, levels)
+            if len(self.plans) > self.max_plans:
+                self.plans.popitem(last=False)
+        return self.plans[key]
+
+
+def torus(n, radius=1.0, tube=0.3):
+    # an n x n quad torus, positions and faces
+    u, v = np.meshgrid(np.arange(n) * 2 * np.pi / n, np.arange(n) * 2 * np.pi / n, indexing="ij")
+    ring = radius + tube * np.cos(v)
+    positions = np.stack([ring * np.cos(u), ring * np.sin(u), tube * np.sin(v)], axis=-1).reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+    corners = [(i, j), ((i + 1) % n, j), ((i + 1) % n, (j + 1) % n), (i, (j + 1) % n)]
+    return positions.astype(np.float32), np.stack([(a * n + b).ravel() for a, b in corners], axis=-1)
+
+
+def benchmark_plan(n=224, levels=3, frames=20):
+    # a deforming cage of n^2 quads: building the plan once, looking it up, and subdividing a frame
+    ti.init(arch=ti.cpu)
+    positions, faces = torus(n)
+    cache = PlanCache()
+    start = time.perf_counter()
+    plan = cache.plan(faces, len(positions), levels)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    assert cache.plan(faces, len(positions), levels) is plan
+    lookup = time.perf_counter() - start
+    start = time.perf_counter()
+    plan.triangles()
+    triangles = time.perf_counter() - start
+    _, _, stencils = subdivide_arrays(positions, faces, levels)
+    taichi_time = numpy_time = 0.0
+    for frame in range(frames + 1):
+        deformed = positions * (1.0 + 0.1 * np.sin(4.0 * positions[:, :1] + 0.1 * frame))
+        start = time.perf_counter()
+        plan.evaluate(deformed)
+        ti.sync()
+        if frame > 0:  # the first one compiles
+            taichi_time += time.perf_counter() - start
+        start = time.perf_counter()
+        for stencil in stencils:
+            deformed = stencil @ deformed
+        numpy_time += time.perf_counter() - start
+    print(f"{len(faces)} faces, {levels} levels: {len(plan.faces)} faces, {plan.positions[-1].shape[0]} vertices")
+    print(f"plan {build:.2f} s, lookup {lookup * 1e3:.1f} ms, triangle indices {triangles * 1e3:.1f} ms")
+    print(f"per frame: taichi {taichi_time / frames * 1e3:.1f} ms, numpy {numpy_time / (frames + 1) * 1e3:.1f} ms")
+    # an evicted plan stays usable, a released one raises instead of reading destroyed fields
+    small_positions, small_faces = torus(4)
+    cache = PlanCache(max_plans=1)
+    evicted = cache.plan(small_faces, len(small_positions), 1)
+    cache.plan(torus(5)[1], 25, 1)
+    assert np.allclose(evicted.evaluate(small_positions).to_numpy(), subdivide_arrays(small_positions, small_faces)[0], atol=1e-6)
+    evicted.release()
+    try:
+        evicted.evaluate(small_positions)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("evaluate() on a released plan")
+
+
+def benchmark(levels=5):
+    # seconds per level of subdivide() and of the array engine: refine (topology and stencil) and S @ P
+    ti.init(arch=ti.cpu)
+    for path in ["data/cube.obj", "data/torus_quad.obj"]:
+        print(path)
+        print(f"{'level':>5} {'faces':>7} {'subdivide [s]':>13} {'refine [s]':>10} {'S @ P [s]':>9} {'nonzeros':>9}")
+        mesh = Mesh(path)
+        half_edges = he.HalfEdgeMesh(*load_obj(path))
+        positions = half_edges.positions
+        for level in range(1, levels + 1):
+            start = time.perf_counter()
+            subdivide(mesh)
+            legacy = time.perf_counter() - start
+            start = time.perf_counter()
+            stencil, faces = refine(half_edges)
+            refine_time = time.perf_counter() - start
+            start = time.perf_counter()
+            positions = stencil @ positions
+            spmv = time.perf_counter() - start
+            half_edges = he.HalfEdgeMesh(positions, faces)
+            assert np.allclose(positions, mesh.half_edges.positions, atol=1e-5)
+            assert np.array_equal(faces.ravel(), mesh.half_edges.origin)
+            print(f"{level:>5} {len(faces):>7} {legacy:>13.3f} {refine_time:>10.4f} {spmv:>9.5f} {len(stencil.weights):>9}")
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", choices=["arrays", "plan"],
+                        help="compare subdivide() with the array engine up to level 5, or time a cached plan on a 50k-face cage")
+    args = parser.parse_args()
+    if args.benchmark == "arrays":
+        benchmark()
+        exit()
+    if args.benchmark == "plan":
+        benchmark_plan()
+        exit()
+
     ti.init(arch=ti.vulkan)
     window = ti.ui.Window("Subdivision", (1024, 1024), vsync=True)
     gui = window.get_gui()
@@ -147,12 +452,10 @@ if __name__ == '__main__':
     camera.lookat(0.0, 0.0, 0.0)
 
     mesh = Mesh("data/cube.obj")
-    vertex_field = he.convert_to_vertex_field(mesh.vertices)
-    index_field = he.convert_to_line_index_field(mesh.edges)
+    fields = he.MeshFields(mesh.half_edges)
 
     face_points, edge_points = subdivide(mesh)
-    new_vertex_field = he.convert_to_vertex_field(mesh.vertices)
-    new_index_field = he.convert_to_line_index_field(mesh.edges)
+    new_fields = he.MeshFields(mesh.half_edges)
 
     while window.running:
         camera.track_user_inputs(window, movement_speed=0.03, hold_key=ti.ui.RMB)
@@ -162,16 +465,15 @@ if __name__ == '__main__':
 
         if gui.button("Subdivide"):
             face_points, edge_points = subdivide(mesh)
-            new_vertex_field = he.convert_to_vertex_field(mesh.vertices)
-            new_index_field = he.convert_to_line_index_field(mesh.edges)
+            new_fields = he.MeshFields(mesh.half_edges)
 
         # original mesh
-        scene.particles(vertex_field, radius=0.02)
-        scene.lines(vertex_field, width=2, indices=index_field)
+        scene.particles(fields.vertices, radius=0.02)
+        scene.lines(fields.vertices, width=2, indices=fields.line_indices)
 
         # new mesh
-        scene.particles(new_vertex_field, radius=0.02, color=(0.0, 0.0, 1.0))
-        scene.lines(new_vertex_field, width=2, indices=new_index_field, color=(0.0, 0.0, 1.0))
+        scene.particles(new_fields.vertices, radius=0.02, color=(0.0, 0.0, 1.0))
+        scene.lines(new_fields.vertices, width=2, indices=new_fields.line_indices, color=(0.0, 0.0, 1.0))
 
         # face points / edge points
         scene.particles(face_points, radius=0.02, color=(1.0, 0.0, 0.0))
@@ -0,0 +1,124 @@
+# Triangle mesh ray tracing
+# "Watertight Ray/Triangle Intersection", Sven Woop, Carsten Benthin, Ingo Wald, JCGT 2013.
+# https://jcgt.org/published/0002/01/05/
+
+import sys
+import time
+import numpy as np
+import taichi as ti
+from bvh import BVH
+from obj_loader import load_obj_triangles
+from raytracing import eps
+
+
+@ti.func
+def intersect_triangle(origin, direction, v0, v1, v2):
+    hit_distance = 10000.0
+    hit_position = ti.Vector([0.0, 0.0, 0.0])
+    hit_normal = ti.Vector([0.0, 0.0, 0.0])
+
+    # permute axes so that z is the dominant ray direction, then shear the ray to +z
+    abs_direction = ti.abs(direction)
+    kz = 0
+    if abs_direction.y > abs_direction[kz]:
+        kz = 1
+    if abs_direction.z > abs_direction[kz]:
+        kz = 2
+    kx = (kz + 1) % 3
+    ky = (kx + 1) % 3
+    if direction[kz] < 0.0:  # keep the winding direction
+        kx, ky = ky, kx
+    sz = 1.0 / direction[kz]
+    sx = direction[kx] * sz
+    sy = direction[ky] * sz
+
+    a, b, c = v0 - origin, v1 - origin, v2 - origin
+    ax, ay = a[kx] - sx * a[kz], a[ky] - sy * a[kz]
+    bx, by = b[kx] - sx * b[kz], b[ky] - sy * b[kz]
+    cx, cy = c[kx] - sx * c[kz], c[ky] - sy * c[kz]
+
+    # scaled barycentrics; edges shared by two triangles give bitwise identical values
+    u = cx * by - cy * bx
+    v = ax * cy - ay * cx
+    w = bx * ay - by * ax
+    inside = not ((u < 0.0 or v < 0.0 or w < 0.0) and (u > 0.0 or v > 0.0 or w > 0.0))
+    det = u + v + w
+    if inside and det != 0.0:
+        t = (u * a[kz] + v * b[kz] + w * c[kz]) * sz / det
+        if t > eps:
+            hit_distance = t
+            hit_position = origin + t * direction
+            hit_normal = ti.math.normalize(ti.math.cross(v1 - v0, v2 - v0))
+            if ti.math.dot(hit_normal, direction) > 0.0:
+                hit_normal = -hit_normal
+    return hit_distance, hit_position, hit_normal
+
+
+@ti.data_oriented
+class TriangleMesh(BVH):
+    def __init__(self, vertex_positions, triangle_indices, leaf_size=4, num_bins=16):
+        self.vertices = ti.Vector.field(3, dtype=float, shape=vertex_positions.shape[0])
+        self.triangles = ti.Vector.field(3, dtype=int, shape=triangle_indices.shape[0])
+        self.vertices.from_numpy(vertex_positions.astype(np.float32))
+        self.triangles.from_numpy(triangle_indices.astype(np.int32))
+        super().__init__(triangle_indices.shape[0], leaf_size, num_bins)
+
+    def primitive_bounds(self):
+        corners = self.vertices.to_numpy()[self.triangles.to_numpy()]
+        return corners.min(axis=1), corners.max(axis=1)
+
+    @ti.func
+    def primitive_box(self, t):
+        v0, v1, v2 = self.vertices[self.triangles[t][0]], self.vertices[self.triangles[t][1]], self.vertices[self.triangles[t][2]]
+        return ti.min(v0, v1, v2), ti.max(v0, v1, v2)
+
+    @ti.func
+    def intersect_primitive(self, t, origin, direction):
+        triangle = self.triangles[t]
+        return intersect_triangle(origin, direction, self.vertices[triangle[0]],
+                                  self.vertices[triangle[1]], self.vertices[triangle[2]])
+
+
+def load_triangle_mesh(file_path, scale=1.0, offset=(0.0, 0.0, 0.0)):
+    vertex_positions, triangle_indices = load_obj_triangles(file_path)
+    return TriangleMesh(vertex_positions * scale + np.array(offset, dtype=np.float32), triangle_indices)
+
+
+if __name__ == '__main__':
+    from bench_util import measure
+
+    ti.init(arch=ti.cpu)
+    width, height = 1024, 1024
+    depth_image = ti.field(dtype=float, shape=(width, height))
+
+    @ti.kernel
+    def trace(mesh: ti.template()):
+        for i, j in depth_image:
+            origin = ti.Vector([0.0, 0.6, 1.0])
+            target = ti.Vector([i / width - 0.5, j / height - 0.5 + 0.1, 0.0])
+            depth_image[i, j] = mesh.intersect(origin, ti.math.normalize(target - origin))[0]
+
+    # tile copies of the torus over the ground until the scene has more than 1M triangles
+    file_path = sys.argv[1] if len(sys.argv) > 1 else "data/torus_quad.obj"
+    start = time.perf_counter()
+    vertex_positions, triangle_indices = load_obj_triangles(file_path)
+    load_time = time.perf_counter() - start
+    copies = int(np.ceil(np.sqrt(1_000_000 / triangle_indices.shape[0])))
+    size = 2.0 / copies
+    extent = vertex_positions.max(axis=0) - vertex_positions.min(axis=0)
+    grid = np.stack(np.meshgrid(np.arange(copies), np.arange(copies), indexing='ij'), axis=-1).reshape(-1, 2)
+    offsets = np.zeros((grid.shape[0], 3), dtype=np.float32)
+    offsets[:, [0, 2]] = (grid + 0.5) * size - 1.0
+    offsets[:, 2] -= 1.0
+    scaled = vertex_positions / extent.max() * size * 0.9
+    all_vertices = (scaled[None] + offsets[:, None]).reshape(-1, 3)
+    all_triangles = (triangle_indices[None] + (np.arange(grid.shape[0]) * vertex_positions.shape[0])[:, None, None]).reshape(-1, 3)
+
+    mesh = TriangleMesh(all_vertices, all_triangles)
+    build_time = measure(mesh.build, repeat=1)
+    refit_time = measure(mesh.refit, repeat=1)
+    trace_time = measure(lambda: trace(mesh))
+    hits = np.count_nonzero(depth_image.to_numpy() < 10000.0)
+    print(f"triangles: {all_triangles.shape[0]} ({copies}x{copies} copies of {file_path}, loaded in {load_time * 1e3:.1f} ms)")
+    print(f"bvh: {mesh.num_nodes} nodes, build {build_time:.2f} s, refit {refit_time * 1e3:.1f} ms")
+    print(f"primary rays: {width * height / trace_time / 1e6:.2f} Mrays/s ({hits} hits)")
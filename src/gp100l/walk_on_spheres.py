@@ -1,6 +1,9 @@
+import argparse
+import numpy as np
 import taichi as ti
 from taichi import math as tm
 import ui_util
+from sampler import Sampler, SAMPLERS
 
 vec2 = tm.vec2
 vec3 = tm.vec3
@@ -27,46 +30,49 @@ def distance_from_boundaries(pos: vec2) -> vec2:
     return vec2(min_distance, float(argmin))
 
 @ti.func
-def sample_on_circle(center: vec2, radius: float) -> vec2:
-    angle = ti.random() * 2.0 * tm.pi
+def sample_on_circle(center: vec2, radius: float, u: float) -> vec2:
+    angle = u * 2.0 * tm.pi
     x = tm.cos(angle) * radius
     y = tm.sin(angle) * radius
     return center + (x, y)
 
 @ti.func
-def recursive_walk(sample_pos: vec2) -> int:
+def recursive_walk(sample_pos: vec2, pixel: int, index: int) -> int:
     curr_pos = vec2(sample_pos[0], sample_pos[1])
     boundary = -1
 
     ti.loop_config(serialize=True)
-    for _ in range(10):
+    for step in range(10):
         result = distance_from_boundaries(curr_pos)
         dist = result[0]
         boundary = int(result[1])
         if dist < 0.001:
             break
-        curr_pos = sample_on_circle(curr_pos, dist)
+        curr_pos = sample_on_circle(curr_pos, dist, sampler.sample(pixel, index, step))
     return boundary
 
 @ti.kernel
-def render():
+def render(num_samples: int):
     for i, j in colors:
-        num_samples = 100
         sum_value = vec3(0.0)
         count = 0
-        for _ in range(num_samples):
+        for index in range(num_samples):
             screen_position = vec2([i / width, j / height])
-            boundary = recursive_walk(screen_position)
+            boundary = recursive_walk(screen_position, i * height + j, index)
             if boundary != -1:
                 sum_value += boundary_colors[boundary]
                 count += 1
         colors[i, j] = sum_value / float(count)
 
 if __name__ == '__main__':
-    ti.init(arch=ti.vulkan)
-    width, height = 1024, 1024
-    window = ti.ui.Window("Walk on Spheres", (width, height), vsync=True)
-    canvas = window.get_canvas()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sampler", choices=SAMPLERS, default="random", help="white noise or R_d quasirandom samples")
+    parser.add_argument("--benchmark", action="store_true", help="print rmse vs samples per pixel for each sampler")
+    args = parser.parse_args()
+
+    ti.init(arch=ti.cpu if args.benchmark else ti.vulkan)
+    width, height = (256, 256) if args.benchmark else (1024, 1024)
+    sampler = Sampler(args.sampler)
 
     num = 6
     centers = ti.Vector.field(2, dtype=float, shape=num)
@@ -83,10 +89,28 @@ if __name__ == '__main__':
         value = i % 2
         boundary_colors[i] = (value, value, value)
 
+    if args.benchmark:
+        # the reference uses a different seed so it shares no samples with the runs below
+        sampler.select("random", seed=1)
+        render(4096)
+        reference = colors.to_numpy()
+        spps = [1, 4, 16, 64, 256]
+        print(f"{'spp':>5}" + "".join(f" {kind + ' rmse':>12}" for kind in SAMPLERS))
+        for spp in spps:
+            errors = []
+            for kind in SAMPLERS:
+                sampler.select(kind)
+                render(spp)
+                errors.append(np.sqrt(np.nanmean((colors.to_numpy() - reference) ** 2)))
+            print(f"{spp:>5}" + "".join(f" {error:>12.5f}" for error in errors))
+        exit()
+
+    window = ti.ui.Window("Walk on Spheres", (width, height), vsync=True)
+    canvas = window.get_canvas()
     selected = -1
     gui = window.get_gui()
     while window.running:
         selected = ui_util.select_and_drag_circle(window, selected, centers, num)
-        render()
+        render(100)
         canvas.set_image(colors)
         window.show()